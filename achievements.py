@@ -0,0 +1,103 @@
+"""
+Event-driven achievements.
+
+Game code reports what happened with ``general.emit_event`` (floor reached, enemy
+defeated, puzzle solved, boss slain). Each rule lists the events that can unlock
+it, so a save only evaluates the rules its events touch, and the unlocked set of
+every save is cached after it is read once.
+"""
+import threading
+from collections import OrderedDict, namedtuple
+
+
+FLOOR_REACHED = 'floor_reached'
+ENEMY_DEFEATED = 'enemy_defeated'
+PUZZLE_SOLVED = 'puzzle_solved'
+BOSS_SLAIN = 'boss_slain'
+
+CACHE_SIZE = 1024
+
+# name and description may use {value}, the value the triggering event carried
+Rule = namedtuple('Rule', ['kind', 'name', 'description', 'events', 'check'])
+
+RULES = (
+    Rule('floor', 'Tower Explorer', 'Reached floor 5', (FLOOR_REACHED,),
+         lambda facts, value: facts['floor'] >= 5),
+    Rule('floor', 'Tower Master', 'Reached floor 10', (FLOOR_REACHED,),
+         lambda facts, value: facts['floor'] >= 10),
+    Rule('combat', 'Monster Slayer', 'Defeated 10 enemies', (ENEMY_DEFEATED, BOSS_SLAIN),
+         lambda facts, value: facts['enemies_defeated'] >= 10),
+    Rule('puzzle', 'Puzzle Master', 'Solved 5 puzzles', (PUZZLE_SOLVED,),
+         lambda facts, value: facts['puzzles_solved'] >= 5),
+    Rule('boss', 'Slayer of {value}', 'Defeated {value}', (BOSS_SLAIN,),
+         lambda facts, value: True),
+)
+
+
+def index_rules(rules):
+    """Group rules by the events that can unlock them"""
+    by_event = {}
+    for rule in rules:
+        for event in rule.events:
+            by_event.setdefault(event, []).append(rule)
+    return by_event
+
+
+def facts_for(session_state):
+    """The game statistics rules are checked against"""
+    return {
+        'floor': session_state.floor,
+        'enemies_defeated': len(session_state.defeated_enemies),
+        'puzzles_solved': len(session_state.solved_puzzles),
+    }
+
+
+class AchievementTracker:
+    """Caches unlocked achievements per save and evaluates only the rules events affect"""
+
+    def __init__(self, rules=RULES, cache_size=CACHE_SIZE):
+        self.rules_by_event = index_rules(rules)
+        self.cache_size = cache_size
+        self._unlocked = OrderedDict()
+        self._lock = threading.Lock()
+
+    def is_loaded(self, save_id):
+        with self._lock:
+            return save_id in self._unlocked
+
+    def load(self, save_id, names):
+        """Seed the cache with the achievements a save already has"""
+        with self._lock:
+            self._unlocked[save_id] = set(names)
+            self._unlocked.move_to_end(save_id)
+            while len(self._unlocked) > self.cache_size:
+                self._unlocked.popitem(last=False)
+
+    def forget(self, save_id):
+        """Drop a save from the cache so it is read again next time"""
+        with self._lock:
+            self._unlocked.pop(save_id, None)
+
+    def evaluate(self, save_id, events, facts):
+        """
+        Check the rules the events affect and return only new unlocks.
+
+        Args:
+            save_id (int): Save the events belong to, must be loaded
+            events (list): (event, value) pairs in the order they happened
+            facts (dict): Current statistics from ``facts_for``
+
+        Returns:
+            list: (kind, name, description) of each newly unlocked achievement
+        """
+        new = []
+        with self._lock:
+            unlocked = self._unlocked[save_id]
+            self._unlocked.move_to_end(save_id)
+            for event, value in events:
+                for rule in self.rules_by_event.get(event, ()):
+                    name = rule.name.format(value=value)
+                    if name not in unlocked and rule.check(facts, value):
+                        unlocked.add(name)
+                        new.append((rule.kind, name, rule.description.format(value=value)))
+        return new
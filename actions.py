@@ -0,0 +1,297 @@
+"""
+Headless game actions.
+
+Every player action is a function ``action(state, content, rng, **args)`` that only
+mutates ``state``, a ``player.PlayerState`` (``st.session_state.game`` in the game):
+no Streamlit, no database. ``apply`` runs one by name with a ``random.Random``
+seeded from the recorded seed, so a save can be rebuilt exactly by replaying its
+recorded actions against the same content. Floors past the authored ones are
+generated from the run's ``tower_seed`` (see ``tower.py``), so they replay too.
+
+Usage:
+    python actions.py SAVE_NAME [--db dnd_game.db]
+"""
+import argparse
+import random
+
+import combat
+import encounter
+import general
+import player
+import tower
+
+
+BASE_SKILL_POINTS = 5
+REST_AMOUNT = 30
+PUZZLE_CHANCE = 0.3
+HORDE_CHANCE = 0.3     # on a floor whose horde is still standing
+MAX_AUTO_TURNS = 500   # stops an auto-battle that can never end (no damage either way)
+# Recorded with every action. Bump it whenever a change to the rules or content
+# makes recorded actions replay differently: status effects, hordes and generated
+# floors all did. Actions recorded under an older version are not replayed.
+RULES_VERSION = 1
+
+
+def new_state(content):
+    """
+    A fresh, not yet started game.
+    """
+    state = player.PlayerState(content)
+    general.init_game(state, content.floor_story[0])
+    return state
+
+
+def start(state, content, rng, player_class, endless=False):
+    """
+    Begin a new run with the chosen class. An ``endless`` run has no top floor.
+    """
+    stats = content.classes[player_class]
+    state.update(
+        player_class=player_class,
+        player_image=stats["image_url"],
+        health=stats["health"],
+        max_health=stats["health"],
+        mana=stats["mana"],
+        max_mana=stats["mana"],
+        strength=stats["strength"],
+        agility=stats["agility"],
+        floor=1,
+        in_combat=False,
+        enemy=None,
+        enemy_group=None,
+        enemy_health=0,
+        in_puzzle=False,
+        puzzle_solved=False,
+        message_log=[content.floor_story[1],
+                     f"You chose {player_class}. {stats['description']} Enjoy!"],
+        message_log_base=0,
+        game_over=False,
+        skill_points=0,
+        pending_skill_points=False,
+        fighting_boss=False,
+        solved_puzzles=set(),
+        enemies_defeated=0,
+        defeated_enemies=set(),
+        encountered_by_floor={},
+        pending_events=[],
+        combat_events=[],
+        effects=None,
+        endless=endless,
+        tower_seed=rng.getrandbits(32),
+    )
+
+
+def allocate(state, content, rng, health=0, mana=0, strength=0, agility=0):
+    """
+    Spend skill points on stats. Returns False if there are not enough points.
+    """
+    total = health + mana + strength + agility
+    if total > state.skill_points:
+        return False
+    state.max_health += health * 10
+    state.max_mana += mana * 10
+    state.strength += strength
+    state.agility += agility
+    state.health = state.max_health
+    state.mana = state.max_mana
+    state.skill_points -= total
+    if state.skill_points == 0:
+        state.pending_skill_points = False
+    return True
+
+
+def _after_player_hit(state, content, rng):
+    if state.enemy_health > 0:
+        combat.enemy_turn(state, rng)
+    # The player's hit or the enemy's damage over time can end the fight
+    if state.in_combat and state.enemy_health <= 0:
+        general.handle_victory(state, encounter, content.bosses, BASE_SKILL_POINTS,
+                               lambda: next_floor(state, content))
+
+
+def attack(state, content, rng, skill=None):
+    """
+    Basic attack, or a class skill if ``skill`` is given.
+    """
+    if combat.player_held(state) or combat.player_attack(state, content.classes, skill, rng) is not None:
+        _after_player_hit(state, content, rng)
+
+
+def spell(state, content, rng):
+    """
+    Cast the generic mana spell.
+    """
+    if combat.player_held(state) or combat.cast_spell(state, rng) is not None:
+        _after_player_hit(state, content, rng)
+
+
+def auto_battle(state, content, rng, policy="basic"):
+    """
+    Fight the current enemy to the end, choosing each turn with ``policy``.
+
+    Every turn goes through the same rules as clicking attack, so the result is
+    what the player would get by clicking through the fight with that policy.
+    See ``combat.choose_skill`` for the policies.
+    """
+    if not state.in_combat or state.game_over:
+        return
+    skills = content.classes[state.player_class]["skills"]
+    combat.choose_skill(skills, 0, policy)  # validates the policy name
+
+    turns = 0
+    enemy = state.enemy
+    # Stops at the end of this fight, even if winning it brings out the boss
+    while state.in_combat and state.enemy is enemy and not state.game_over and turns < MAX_AUTO_TURNS:
+        attack(state, content, rng, combat.choose_skill(skills, state.mana, policy))
+        turns += 1
+    state.message_log.append(f"Auto-battle ended after {turns} turns.")
+
+
+def guard(state, content, rng):
+    """
+    Raise your guard and take the enemy's turn.
+    """
+    state.message_log.append("You raise your guard!")
+    if state.in_combat and not state.game_over and state.enemy:
+        combat.log_event(state, 'player', 'guard', 0, state.health, state.enemy_health)
+        _after_player_hit(state, content, rng)
+
+
+def answer(state, content, rng, text):
+    """
+    Answer the current floor's puzzle.
+    """
+    if not state.in_puzzle or state.floor not in content.puzzles:
+        return
+
+    correct = content.puzzles[state.floor]["answer"]
+    if text.strip().lower() == correct:
+        state.solved_puzzles.add(state.floor)
+        state.puzzle_solved = True
+        state.in_puzzle = False
+        state.message_log.append("Puzzle solved! You may proceed.")
+        general.emit_event(state, 'puzzle_solved', state.floor)
+        state.skill_points += BASE_SKILL_POINTS
+        state.pending_skill_points = True
+        explore(state, content, rng)
+    else:
+        state.message_log.append("Wrong answer, try again.")
+        state.in_combat = False
+
+
+def next_floor(state, content):
+    """
+    Advance to the next floor of the tower, or win at the top.
+    """
+    if state.floor < tower.top(state, content):
+        state.floor += 1
+        state.enemies_defeated = 0
+        state.message_log.append(f"You advance to floor {state.floor}.")
+        state.message_log.append(content.floor_story[state.floor])
+        general.emit_event(state, 'floor_reached', state.floor)
+        state.in_combat = False
+        state.enemy = None
+        state.enemy_group = None
+        state.enemy_health = 0
+        state.in_puzzle = False
+        state.puzzle_solved = False
+        state.fighting_boss = False
+    else:
+        state.message_log.append("You have reached the top of the tower!")
+        state.game_over = True
+
+
+def explore(state, content, rng):
+    """
+    Look around the floor for an enemy or a puzzle.
+    """
+    if state.in_combat or state.game_over or state.in_puzzle:
+        return
+
+    if (state.floor not in state.solved_puzzles and
+            rng.random() < PUZZLE_CHANCE and
+            state.floor in content.puzzles):
+        encounter.start_puzzle(state, content.puzzles)
+    elif (state.floor in content.hordes and
+            content.hordes[state.floor]['name'] not in state.defeated_enemies and
+            rng.random() < HORDE_CHANCE):
+        encounter.start_horde(state, content.hordes[state.floor])
+    else:
+        encounter.encounter_enemy(state, lambda: next_floor(state, content), tower.top(state, content),
+                                  content.enemies, rng, content.enemy_names)
+
+
+def rest(state, content, rng):
+    """
+    Recover some health and mana, which may draw an encounter.
+    """
+    if state.in_combat or state.game_over or state.in_puzzle:
+        return
+
+    heal_amount = min(REST_AMOUNT, state.max_health - state.health)
+    mana_amount = min(REST_AMOUNT, state.max_mana - state.mana)
+    state.health += heal_amount
+    state.mana += mana_amount
+    state.message_log.append(f"You rest and recover {heal_amount} HP and {mana_amount} mana.")
+    explore(state, content, rng)
+
+
+ACTIONS = {
+    'start': start,
+    'allocate': allocate,
+    'attack': attack,
+    'auto': auto_battle,
+    'spell': spell,
+    'guard': guard,
+    'answer': answer,
+    'explore': explore,
+    'rest': rest,
+}
+
+
+def apply(state, content, action, args, seed):
+    """
+    Run one recorded action with its own seeded random source.
+    """
+    content = tower.for_state(state, content)
+    result = ACTIONS[action](state, content, random.Random(seed), **args)
+    state.event_seq = getattr(state, 'event_seq', 0) + 1
+    return result
+
+
+def replay(state, content, events):
+    """
+    Apply (action, args, seed) events in order.
+    """
+    for action, args, seed in events:
+        apply(state, content, action, args, seed)
+    return state
+
+
+def rebuild(content, events):
+    """
+    Rebuild a run from its full event history.
+    """
+    return replay(new_state(content), content, events)
+
+
+def main(argv=None):
+    from content import get_content
+    from database import get_database
+
+    parser = argparse.ArgumentParser(description="Replay a saved run from its recorded actions.")
+    parser.add_argument('save_name')
+    parser.add_argument('--db', default="dnd_game.db")
+    parser.add_argument('--data', default='dnd_game_data.json')
+    args = parser.parse_args(argv)
+
+    events = get_database(args.db).get_events(args.save_name)
+    state = rebuild(get_content(args.data), events)
+    for line in state.message_log:
+        print(line)
+    print(f"\n{len(events)} actions replayed: floor {state.floor}, "
+          f"HP {state.health}/{state.max_health}, game over: {state.game_over}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,348 @@
+"""
+Micro-benchmarks for the game's hot paths.
+
+Times the damage rules, encounters and victory handling at several content sizes
+(the game data with every floor's enemy list multiplied), a horde's AoE hit and
+counter-attack at several group sizes, content compilation,
+and ``GameDatabase`` saves, loads and achievement checks at several message-log
+sizes against a temporary database.
+
+Results are seconds per call (best of several runs), except ``session_bytes``:
+the memory one session holds after that many scripted actions, fresh and as
+loaded back from its save, averaged over SESSIONS sessions. ``--save`` stores them as the
+JSON baseline; later runs compare against it and exit with status 1 if any
+benchmark got slower than the baseline by more than ``--threshold``.
+
+Usage:
+    python benchmarks.py [--save] [--baseline benchmarks.json] [--threshold 0.25] [--filter NAME]
+"""
+import argparse
+import copy
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import timeit
+import tracemalloc
+
+import actions
+import combat
+import encounter
+import general
+import groups
+import player
+import tower
+from content import DATA_FILE, compile_content
+from database import GameDatabase
+from loadtest import choose_action
+
+
+BASELINE_FILE = 'benchmarks.json'
+DEFAULT_THRESHOLD = 0.25
+REPEAT = 5
+CONTENT_SCALES = (1, 10, 100)
+LOG_SIZES = (50, 1000, 10000)
+HORDE_SIZES = (10, 100, 1000)
+SESSION_ACTIONS = (0, 300)
+SESSIONS = 200
+HUGE = 10 ** 9   # health that never runs out while a benchmark loops
+
+
+def scale_data(game_data, factor):
+    """Game data with every floor's enemy list repeated ``factor`` times under new names"""
+    data = copy.deepcopy(game_data)
+    for floor, enemies in data['ENEMIES'].items():
+        data['ENEMIES'][floor] = [dict(enemy, name=f"{enemy['name']} {i}") if i else enemy
+                                  for i in range(factor) for enemy in enemies]
+    return data
+
+
+def measure(call, repeat=REPEAT):
+    """Best seconds per call over ``repeat`` runs"""
+    timer = timeit.Timer(call)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number
+
+
+def fighting_state(content, rng):
+    """A started Knight run in a fight with the first floor-1 enemy"""
+    state = actions.new_state(content)
+    actions.start(state, content, rng, 'Knight')
+    state.enemy = content.enemies[1][0]
+    state.enemy_health = HUGE
+    state.in_combat = True
+    return state
+
+
+def combat_benchmarks(content):
+    rng = random.Random(0)
+    state = fighting_state(content, rng)
+
+    def player_attack():
+        state.enemy_health = HUGE
+        combat.player_attack(state, content.classes, None, rng)
+        state.message_log.clear()
+        state.combat_events.clear()
+
+    def enemy_attack():
+        state.health = HUGE
+        state.game_over = False
+        combat.enemy_attack(state, rng)
+        state.message_log.clear()
+        state.combat_events.clear()
+
+    yield 'player_attack', player_attack
+    yield 'enemy_attack', enemy_attack
+
+
+def horde_benchmarks(content, size):
+    rng = random.Random(0)
+    state = fighting_state(content, rng)
+    horde = {'name': "Benchmark Horde", 'members': [dict(content.enemies[1][0], health=HUGE, count=size)]}
+
+    def start():
+        state.enemy_group = groups.EnemyGroup.from_horde(horde)
+        state.enemy = groups.summary(horde, state.enemy_group)
+        state.enemy_health = state.enemy_group.remaining()
+
+    start()
+
+    def aoe_attack():
+        state.mana = HUGE
+        combat.player_attack(state, content.classes, 'Whirlwind', rng)
+        if state.enemy_health <= 0:
+            start()
+        state.message_log.clear()
+        state.combat_events.clear()
+
+    def enemy_attack():
+        state.health = HUGE
+        state.game_over = False
+        combat.enemy_attack(state, rng)
+        state.message_log.clear()
+        state.combat_events.clear()
+
+    yield f'horde_aoe_attack[{size}]', aoe_attack
+    yield f'horde_enemy_attack[{size}]', enemy_attack
+
+
+def content_benchmarks(game_data, scale):
+    data = scale_data(game_data, scale)
+    content = compile_content(data)
+    rng = random.Random(0)
+    state = fighting_state(content, rng)
+    # One beaten enemy on the floor, so encounters take the filtering path
+    state.defeated_enemies = {content.enemies[1][0]['name']}
+    next_floor = lambda: None
+
+    def encounter_enemy():
+        state.in_combat = False
+        encounter.encounter_enemy(state, next_floor, tower.max_floor(content), content.enemies, rng, content.enemy_names)
+        state.message_log.clear()
+
+    enemy = content.enemies[1][-1]
+
+    def handle_victory():
+        state.enemy = enemy
+        state.enemies_defeated = 0
+        general.handle_victory(state, encounter, content.bosses, actions.BASE_SKILL_POINTS, next_floor)
+        state.message_log.clear()
+        state.pending_events.clear()
+
+    yield f'compile_content[x{scale}]', lambda: compile_content(data)
+    yield f'encounter_enemy[x{scale}]', encounter_enemy
+    yield f'handle_victory[x{scale}]', handle_victory
+
+
+def database_benchmarks(db, content, log_size):
+    rng = random.Random(0)
+    save_name = f'bench_log_{log_size}'
+    state = actions.new_state(content)
+    actions.start(state, content, rng, 'Mage')
+    state.message_log = player.MessageLog([f"Log line {i}" for i in range(log_size)], capacity=log_size)
+    save_id = db.save_game(save_name, state)
+
+    def save_game():
+        # The in-memory log stays at log_size lines while the stored one grows
+        state.message_log.append("One more line")
+        db.save_game(save_name, state)
+
+    def load_game():
+        db.read_cache.clear()
+        db.load_game(save_name)
+
+    events = [('enemy_defeated', 'Goblin'), ('floor_reached', 2)]
+    facts = {'floor': 2, 'enemies_defeated': 1, 'puzzles_solved': 0}
+
+    def check_achievements():
+        with db.connection() as conn:
+            db.check_achievements(conn.cursor(), save_id, events, facts)
+
+    yield f'save_game[log={log_size}]', save_game
+    yield f'load_game[log={log_size}]', load_game
+    yield f'load_game_cached[log={log_size}]', lambda: db.load_game(save_name)
+    if log_size == LOG_SIZES[0]:
+        yield 'check_achievements', check_achievements
+
+
+def played_session(content, rng, n_actions):
+    """A session after ``n_actions`` scripted actions, with its combat records and events handed off"""
+    state = actions.new_state(content)
+    actions.apply(state, content, 'start', {'player_class': rng.choice(list(content.classes))}, rng.getrandbits(32))
+    for _ in range(n_actions):
+        if state.game_over:
+            break
+        action, args = choose_action(state, content, rng)
+        actions.apply(state, content, action, args, rng.getrandbits(32))
+    combat.take_fights(state)
+    general.take_events(state)
+    return state
+
+
+def traced(build):
+    """Bytes still allocated by ``build()`` once it returns, and its result"""
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = build()
+        return tracemalloc.get_traced_memory()[0] - before, result
+    finally:
+        tracemalloc.stop()
+
+
+def memory_benchmarks(db, content, n_actions):
+    """Bytes per session, fresh from play and loaded back from a save"""
+    rng = random.Random(n_actions)
+    played_session(content, rng, 50)  # warm up lazy imports and caches
+    used, states = traced(lambda: [played_session(content, rng, n_actions) for _ in range(SESSIONS)])
+    results = {f'session_bytes[actions={n_actions}]': used / SESSIONS}
+
+    names = [f'bench_memory_{n_actions}_{i}' for i in range(SESSIONS)]
+    for name, state in zip(names, states):
+        db.save_game(name, state)
+    del states
+
+    def load(name):
+        save_data = db.load_game(name)
+        db.read_cache.clear()  # count what the session holds, not the cache
+        events = save_data.pop('replay_events')
+        save_data.pop('stale_events')
+        state = actions.new_state(content)
+        state.update({key: value for key, value in save_data.items()
+                      if key not in ('id', 'save_name', 'created_at', 'updated_at')})
+        return actions.replay(state, content, events)
+
+    db.flush()
+    used, _ = traced(lambda: [load(name) for name in names])
+    results[f'session_bytes[actions={n_actions},loaded]'] = used / SESSIONS
+    return results
+
+
+def run(data=DATA_FILE, name_filter=None, repeat=REPEAT):
+    """Run every benchmark whose name contains ``name_filter``; returns {name: seconds per call}"""
+    with open(data) as f:
+        game_data = json.load(f)
+    content = compile_content(game_data)
+
+    tmpdir = tempfile.mkdtemp(prefix="dnd-bench-")
+    db = GameDatabase(os.path.join(tmpdir, "bench.db"))
+    try:
+        cases = list(combat_benchmarks(content))
+        for size in HORDE_SIZES:
+            cases.extend(horde_benchmarks(content, size))
+        for scale in CONTENT_SCALES:
+            cases.extend(content_benchmarks(game_data, scale))
+        for log_size in LOG_SIZES:
+            cases.extend(database_benchmarks(db, content, log_size))
+
+        results = {}
+        for name, call in cases:
+            if name_filter is None or name_filter in name:
+                results[name] = measure(call, repeat)
+        for n_actions in SESSION_ACTIONS:
+            # Each run yields several results, so the filter applies to their names afterwards
+            results.update((name, value) for name, value in memory_benchmarks(db, content, n_actions).items()
+                           if name_filter is None or name_filter in name)
+        return results
+    finally:
+        db.close()
+        db.pool.close()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)['results']
+
+
+def save_baseline(path, results):
+    with open(path, 'w') as f:
+        json.dump({
+            'python': sys.version.split()[0],
+            'machine': platform.machine(),
+            'results': results,
+        }, f, indent=2, sort_keys=True)
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Benchmarks slower (or for session_bytes, bigger) than their baseline by more
+    than ``threshold`` (0.25 = 25%).
+
+    Returns:
+        list: (name, baseline value, current value) of each regression
+    """
+    return [(name, baseline[name], seconds) for name, seconds in results.items()
+            if name in baseline and seconds > baseline[name] * (1 + threshold)]
+
+
+def format_value(name, value):
+    if name.startswith('session_bytes'):
+        return f"{value:>11.0f}B"
+    return f"{value * 1e6:>10.2f}us"
+
+
+def format_results(results, baseline):
+    """Render results, with the change against the baseline, as a plain-text table"""
+    lines = [f"{'Benchmark':<36} {'Result':>12} {'Baseline':>12} {'Change':>8}"]
+    for name, value in results.items():
+        line = f"{name:<36} {format_value(name, value)}"
+        if name in baseline:
+            line += f" {format_value(name, baseline[name])} {(value / baseline[name] - 1) * 100:>+7.1f}%"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the game's hot paths against a stored baseline.")
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--save', action='store_true', help="store these results as the new baseline")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="allowed slowdown before failing, 0.25 = 25%%")
+    parser.add_argument('--filter', default=None, help="only run benchmarks whose name contains this")
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    parser.add_argument('--data', default=DATA_FILE)
+    args = parser.parse_args(argv)
+
+    results = run(args.data, args.filter, args.repeat)
+    baseline = load_baseline(args.baseline)
+    print(format_results(results, baseline))
+
+    if args.save:
+        save_baseline(args.baseline, dict(baseline, **results))
+        print(f"\nBaseline saved to {args.baseline}")
+        return 0
+
+    regressions = compare(results, baseline, args.threshold)
+    for name, before, now in regressions:
+        print(f"REGRESSION {name}: {format_value(name, before).strip()} -> {format_value(name, now).strip()}")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,403 @@
+"""
+Headless combat rules.
+
+Every function here works on a plain ``state`` object (``st.session_state`` in the
+game, any attribute-style object elsewhere) and takes the random source as an
+argument, so fights can be resolved without Streamlit. Saving, victory rewards and
+UI updates stay with the caller.
+
+Each resolved action is also appended to ``state.combat_events`` as a structured
+record (see ``log_event``); a fight ends with a "victory" or "defeat" record and
+``take_fights`` hands the records to the database after every action, including
+those of a fight still in progress.
+
+Status effects (see ``effects.py``) are kept in ``state.effects``: hits inflict
+them, ``enemy_turn`` ticks both sides once per round and ``player_held`` spends
+a turn the player lost to freeze or stun.
+
+A horde (see ``groups.py``) is fought like one enemy whose health is the group's
+total: single-target damage hits the front member, AoE skills hit every member
+and all members counter-attack together.
+"""
+import random as _random
+from collections import Counter
+
+import numpy as np
+
+import effects
+import metrics
+
+
+SPELL_COST = 20
+SPELL_BONUS = 10
+MAX_CRIT_CHANCE = 0.3
+MIN_EVASION_CHANCE = 0.05
+AOE_EFFECTS = ('aoe', 'stun_aoe')   # skill effects that hit every member of a group
+FIGHT_ENDS = ('victory', 'defeat')  # actions of the record that ends a fight
+
+
+def log_event(state, actor, action, damage, player_before, enemy_before, skill=None, crit=False, evaded=False):
+    """
+    Append one structured combat record to the state's buffer.
+    """
+    events = getattr(state, 'combat_events', None)
+    if events is None:
+        events = state.combat_events = []
+    events.append({
+        'floor': getattr(state, 'floor', None),
+        'enemy': state.enemy['name'],
+        'player_class': getattr(state, 'player_class', None),
+        'actor': actor,
+        'action': action,
+        'skill': skill,
+        'damage': damage,
+        'crit': crit,
+        'evaded': evaded,
+        'player_before': player_before,
+        'player_after': state.health,
+        'enemy_before': enemy_before,
+        'enemy_after': state.enemy_health,
+    })
+
+
+def take_fights(state):
+    """
+    Remove and return every buffered record, split by fight.
+
+    Returns:
+        list: One list of records per fight, oldest first; the last one may be
+        the start of a fight still in progress
+    """
+    events = getattr(state, 'combat_events', None)
+    if not events:
+        return []
+    fights = []
+    start = 0
+    for i, event in enumerate(events):
+        if event['action'] in FIGHT_ENDS:
+            fights.append(events[start:i + 1])
+            start = i + 1
+    if start < len(events):
+        fights.append(events[start:])
+    state.combat_events = []
+    return fights
+
+
+def _log_kill(state):
+    if state.enemy_health <= 0:
+        log_event(state, 'player', 'victory', 0, state.health, state.enemy_health)
+
+
+def _effects(state):
+    current = getattr(state, 'effects', None)
+    if current is None:
+        current = state.effects = effects.new_effects()
+    return current
+
+
+def _target_name(state, target):
+    return "You are" if target == 'player' else f"The {state.enemy['name']} is"
+
+
+def inflict(state, target, record, base_damage, rng=_random):
+    """
+    Roll the status effect of a skill or enemy ``record`` onto ``target`` after a hit.
+
+    Returns:
+        str or None: The status inflicted
+    """
+    found = effects.source(record)
+    if found is None:
+        return None
+    status, chance = found
+    if chance < 1 and rng.random() >= chance:
+        return None
+    if not effects.inflict(_effects(state), target, status, base_damage):
+        return None
+    state.message_log.append(f"{_target_name(state, target)} {effects.EFFECTS[status]['label']}!")
+    return status
+
+
+def tick_effects(state, target):
+    """
+    Expire ``target``'s finished effects and deal its damage over time for this turn.
+
+    Returns:
+        bool: False if the target loses this turn to freeze or stun
+    """
+    current = _effects(state)
+    turn = current['turn']
+    effects.expire(current, target, turn)
+    side = current[target]
+    if side['damage']:
+        statuses = ', '.join(side['stacks'])
+        player_before, enemy_before = state.health, state.enemy_health
+        if target == 'player':
+            state.health = max(0, state.health - side['damage'])
+            state.message_log.append(f"You take {side['damage']} damage from {statuses}.")
+        else:
+            state.message_log.append(f"The {state.enemy['name']} takes {side['damage']} damage from {statuses}.")
+            hurt_enemy(state, side['damage'])
+        # Credited to the side whose hit inflicted the effects
+        source = 'enemy' if target == 'player' else 'player'
+        log_event(state, source, 'effect', side['damage'], player_before, enemy_before, statuses)
+        if target == 'player' and state.health <= 0:
+            state.game_over = True
+            state.message_log.append("You died. Game over.")
+            log_event(state, 'enemy', 'defeat', 0, state.health, state.enemy_health)
+            return False
+        if target == 'enemy' and state.enemy_health <= 0:
+            _log_kill(state)
+            return False
+    status = effects.held(current, target, turn)
+    if status is not None and target == 'enemy':
+        state.message_log.append(f"The {state.enemy['name']} is {effects.EFFECTS[status]['label']} "
+                                 f"and cannot attack!")
+    return status is None
+
+
+def player_held(state):
+    """
+    Spend the player's turn if freeze or stun takes it.
+
+    Returns:
+        bool: True if the turn was lost
+    """
+    current = getattr(state, 'effects', None)
+    if not current or not state.in_combat or state.game_over:
+        return False
+    # The player's next turn is the round after the last enemy turn
+    status = effects.held(current, 'player', current['turn'] + 1)
+    if status is None:
+        return False
+    state.message_log.append(f"You are {effects.EFFECTS[status]['label']} and lose your turn!")
+    log_event(state, 'player', status, 0, state.health, state.enemy_health)
+    return True
+
+
+def hurt_enemy(state, damage, everyone=False):
+    """
+    Take ``damage`` off the current enemy: a group's front member, or all of them.
+    """
+    group = getattr(state, 'enemy_group', None)
+    if group is None:
+        state.enemy_health -= damage
+        return
+    killed = group.hit(damage, everyone)
+    state.enemy_health = group.remaining()
+    if killed:
+        names = ', '.join(name if n == 1 else f"{name} x{n}" for name, n in Counter(killed).items())
+        state.message_log.append(f"Slain: {names}. {len(group.alive())} left standing.")
+
+
+def crit_chance(agility):
+    """
+    Chance for a player attack to be a critical hit.
+    """
+    return min(MAX_CRIT_CHANCE, agility / 100)
+
+
+def evasion_chance(player_agility, enemy_agility):
+    """
+    Chance for the player to evade an enemy attack.
+    """
+    return max(MIN_EVASION_CHANCE, (player_agility - enemy_agility) / 100)
+
+
+def evasion_chances(player_agility, enemy_agility):
+    """
+    ``evasion_chance`` for an array of enemy agilities, e.g. a group's members.
+    The two must stay the same formula; the load test checks that they agree.
+    """
+    return np.maximum(MIN_EVASION_CHANCE, (player_agility - np.asarray(enemy_agility)) / 100)
+
+
+def enemy_damage(enemy_strength, player_agility):
+    """
+    Damage an enemy deals when its attack lands.
+    """
+    return max(1, enemy_strength - (player_agility // 3))
+
+
+def enemy_damages(enemy_strength, player_agility):
+    """
+    ``enemy_damage`` for an array of enemy strengths, e.g. a group's members.
+    The two must stay the same formula; the load test checks that they agree.
+    """
+    return np.maximum(1, np.asarray(enemy_strength) - (player_agility // 3))
+
+
+def attack_damage(base_damage, crit, variance):
+    """
+    Final damage of a player attack after crit bonus and variance roll.
+    """
+    return max(1, base_damage + (base_damage // 2 if crit else 0) - variance)
+
+
+def choose_skill(skills, mana, policy="basic"):
+    """
+    Pick the skill a scripted player uses this turn.
+
+    Args:
+        skills (dict): The class's skills, as in ``CLASSES[name]["skills"]``
+        mana (int): Mana the player currently has
+        policy (str): "basic" always attacks, "skills" uses the strongest affordable skill
+
+    Returns:
+        str or None: Skill name, or None for a basic attack
+    """
+    if policy == "basic":
+        return None
+    if policy != "skills":
+        raise ValueError(f"Unknown combat policy: {policy}")
+    best = None
+    for name, info in skills.items():
+        if info["cost"] <= mana and (best is None or info["damage_mult"] > skills[best]["damage_mult"]):
+            best = name
+    return best
+
+
+def player_attack(state, classes, skill=None, rng=_random):
+    """
+    Resolve the player's attack or skill against the current enemy.
+
+    Returns:
+        int or None: Damage dealt (the health a group lost, for a skill that hits
+        all of it), or None if the attack could not be made
+    """
+    if not state.in_combat or state.game_over:
+        return None
+
+    if skill:
+        skill_info = classes[state.player_class]["skills"][skill]
+        base_damage = int(state.strength * skill_info["damage_mult"])
+        mana_cost = skill_info["cost"]
+        if state.mana < mana_cost:
+            state.message_log.append(f"Not enough mana for {skill}!")
+            return None
+        state.mana -= mana_cost
+    else:
+        base_damage = state.strength
+
+    crit = rng.random() < crit_chance(state.agility)
+    damage = attack_damage(base_damage, crit, rng.randint(0, 3))
+
+    everyone = bool(skill) and skill_info.get("effect") in AOE_EFFECTS
+    targets = len(state.enemy_group.alive()) if everyone and getattr(state, 'enemy_group', None) else 1
+    if targets > 1:
+        msg = f"You use {skill} and deal {damage} damage to {targets} enemies!"
+    else:
+        msg = f"You use {skill} and deal {damage} damage!" if skill else f"You dealt {damage} damage"
+    if crit:
+        msg += " (Critical hit!)"
+    state.message_log.append(msg)
+    enemy_before = state.enemy_health
+    hurt_enemy(state, damage, everyone)
+    if targets > 1:
+        # The record is of the health the whole group lost, not the damage to each member
+        damage = enemy_before - state.enemy_health
+    log_event(state, 'player', 'skill' if skill else 'attack', damage, state.health, enemy_before, skill, crit)
+    _log_kill(state)
+    if skill and state.enemy_health > 0:
+        inflict(state, 'enemy', skill_info, base_damage, rng)
+    return damage
+
+
+def cast_spell(state, rng=_random):
+    """
+    Resolve the generic mana spell against the current enemy.
+
+    Returns:
+        int or None: Damage dealt, or None if the spell could not be cast
+    """
+    if not state.in_combat or state.game_over:
+        return None
+
+    if state.mana < SPELL_COST:
+        state.message_log.append("Not enough mana to cast a spell!")
+        return None
+
+    state.mana -= SPELL_COST
+    damage = max(1, state.strength + SPELL_BONUS - rng.randint(0, 5))
+    state.message_log.append(f"You cast a spell dealing {damage} damage!")
+    enemy_before = state.enemy_health
+    hurt_enemy(state, damage)
+    log_event(state, 'player', 'spell', damage, state.health, enemy_before)
+    _log_kill(state)
+    return damage
+
+
+def enemy_turn(state, rng=_random):
+    """
+    The enemy's half of a round: status effects on both sides tick, then the enemy
+    attacks if it is still standing and not held.
+    """
+    if not state.in_combat or state.game_over or not state.enemy:
+        return
+    _effects(state)['turn'] += 1
+    enemy_acts = tick_effects(state, 'enemy')
+    if state.enemy_health <= 0:
+        return
+    tick_effects(state, 'player')
+    if enemy_acts and not state.game_over:
+        enemy_attack(state, rng)
+
+
+@metrics.timed('action.enemy_attack')
+def enemy_attack(state, rng=_random):
+    """
+    Resolve the current enemy's attack on the player.
+
+    Returns:
+        int: Damage taken (0 if evaded or no attack happened)
+    """
+    if not state.in_combat or state.game_over or not state.enemy:
+        return 0
+
+    enemy = state.enemy
+    player_before = state.health
+    group = getattr(state, 'enemy_group', None)
+    if group is not None:
+        damage = _group_attack(state, group, rng)
+        if damage == 0:
+            log_event(state, 'enemy', 'attack', 0, player_before, state.enemy_health, evaded=True)
+            return 0
+    elif rng.random() < evasion_chance(state.agility, enemy.get("agility", 5)):
+        state.message_log.append("You evaded the enemy's attack!")
+        log_event(state, 'enemy', 'attack', 0, player_before, state.enemy_health, evaded=True)
+        return 0
+    else:
+        damage = enemy_damage(enemy["strength"], state.agility)
+        state.message_log.append(f"Enemy hits you for {damage} damage.")
+
+    state.health -= damage
+    if state.health <= 0:
+        state.health = 0
+        state.game_over = True
+        state.message_log.append("You died. Game over.")
+    log_event(state, 'enemy', 'attack', damage, player_before, state.enemy_health)
+    if state.game_over:
+        log_event(state, 'enemy', 'defeat', 0, state.health, state.enemy_health)
+    else:
+        inflict(state, 'player', enemy, enemy["strength"], rng)
+    return damage
+
+
+def _group_attack(state, group, rng):
+    """
+    Every standing member of a group attacks at once, with the same evasion and
+    damage rules as a single enemy.
+
+    Returns:
+        int: Total damage of the hits that landed
+    """
+    members = group.alive()
+    # Member rolls come from a generator seeded by the action's random source, so replays match
+    rolls = np.random.default_rng(rng.getrandbits(64)).random(members.size)
+    landed = members[rolls >= evasion_chances(state.agility, group.agility[members])]
+    damage = int(enemy_damages(group.strength[landed], state.agility).sum())
+    if landed.size:
+        state.message_log.append(f"{landed.size} of {members.size} enemies hit you for {damage} damage.")
+    else:
+        state.message_log.append(f"You evaded all {members.size} attacks!")
+    return damage
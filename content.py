@@ -0,0 +1,160 @@
+"""
+Game content registry.
+
+Loads ``dnd_game_data.json`` once per process, validates it and compiles it into
+read-only records with per-floor indexes. Streamlit reruns only pay for an
+``os.stat``: the file is re-read when its mtime or size changes, and recompiled
+only if its hash changed too.
+"""
+import hashlib
+import json
+import os
+import threading
+from collections import namedtuple
+from types import MappingProxyType
+
+
+DATA_FILE = 'dnd_game_data.json'
+
+Content = namedtuple('Content', [
+    'config',         # GAME_CONFIG values
+    'classes',        # class name -> record (with read-only skills)
+    'enemies',        # floor -> tuple of enemy records
+    'enemy_names',    # floor -> frozenset of enemy names on that floor
+    'bosses',         # floor -> boss record
+    'hordes',         # floor -> horde record (name, members with counts), optional section
+    'puzzles',        # floor -> puzzle record
+    'floor_story',    # floor -> story text
+    'roster',         # every enemy, boss and horde record, so a session can refer to one by index
+    'roster_ids',     # name -> index in roster
+    'digest',         # sha256 of the source file
+])
+
+CLASS_FIELDS = ('image_url', 'health', 'mana', 'strength', 'agility', 'description', 'skills')
+SKILL_FIELDS = ('cost', 'damage_mult')
+ENEMY_FIELDS = ('name', 'health', 'strength')
+PUZZLE_FIELDS = ('question', 'answer')
+HORDE_FIELDS = ('name', 'members')
+
+_cache = {}
+_lock = threading.Lock()
+
+
+def _freeze(record):
+    """Read-only view of a record, nested dicts included"""
+    return MappingProxyType({k: _freeze(v) if isinstance(v, dict) else v for k, v in record.items()})
+
+
+def _floors(section, name, problems):
+    """Convert a floor-keyed section to int keys, noting keys that are not floors"""
+    floors = {}
+    for key, value in section.items():
+        try:
+            floors[int(key)] = value
+        except ValueError:
+            problems.append(f"{name}: '{key}' is not a floor number")
+    return floors
+
+
+def _missing(record, fields, where, problems):
+    for field in fields:
+        if field not in record:
+            problems.append(f"{where}: missing '{field}'")
+
+
+def validate(game_data):
+    """
+    Check the raw game data and return a list of problems (empty when valid).
+    """
+    problems = []
+    for section in ('CLASSES', 'ENEMIES', 'BOSSES', 'PUZZLES', 'FLOOR_STORY'):
+        if section not in game_data:
+            problems.append(f"missing section '{section}'")
+    if problems:
+        return problems
+
+    for name, info in game_data['CLASSES'].items():
+        _missing(info, CLASS_FIELDS, f"CLASSES.{name}", problems)
+        for skill, details in info.get('skills', {}).items():
+            _missing(details, SKILL_FIELDS, f"CLASSES.{name}.skills.{skill}", problems)
+
+    for floor, enemies in _floors(game_data['ENEMIES'], 'ENEMIES', problems).items():
+        for i, enemy in enumerate(enemies):
+            _missing(enemy, ENEMY_FIELDS, f"ENEMIES.{floor}[{i}]", problems)
+    for floor, boss in _floors(game_data['BOSSES'], 'BOSSES', problems).items():
+        _missing(boss, ENEMY_FIELDS, f"BOSSES.{floor}", problems)
+    for floor, horde in _floors(game_data.get('HORDES', {}), 'HORDES', problems).items():
+        _missing(horde, HORDE_FIELDS, f"HORDES.{floor}", problems)
+        for i, member in enumerate(horde.get('members', ())):
+            _missing(member, ENEMY_FIELDS, f"HORDES.{floor}.members[{i}]", problems)
+    for floor, puzzle in _floors(game_data['PUZZLES'], 'PUZZLES', problems).items():
+        _missing(puzzle, PUZZLE_FIELDS, f"PUZZLES.{floor}", problems)
+
+    story = _floors(game_data['FLOOR_STORY'], 'FLOOR_STORY', problems)
+    for floor in (0, 1):
+        if floor not in story:
+            problems.append(f"FLOOR_STORY: missing floor {floor}")
+    return problems
+
+
+def compile_content(game_data, digest=None):
+    """
+    Validate raw game data and compile it into a ``Content`` record.
+
+    Raises:
+        ValueError: If the data is missing sections or fields
+    """
+    problems = validate(game_data)
+    if problems:
+        raise ValueError("Invalid game data:\n  " + "\n  ".join(problems))
+
+    enemies = {int(k): tuple(_freeze(e) for e in v) for k, v in game_data['ENEMIES'].items()}
+    bosses = {int(k): _freeze(v) for k, v in game_data['BOSSES'].items()}
+    hordes = {int(k): _freeze(dict(v, members=tuple(_freeze(m) for m in v['members'])))
+              for k, v in game_data.get('HORDES', {}).items()}
+    roster = tuple(e for floor in sorted(enemies) for e in enemies[floor])
+    roster += tuple(bosses[floor] for floor in sorted(bosses)) + tuple(hordes[floor] for floor in sorted(hordes))
+    roster_ids = {}
+    for i, record in enumerate(roster):
+        roster_ids.setdefault(record['name'], i)
+    return Content(
+        config=_freeze(game_data.get('GAME_CONFIG', {})),
+        classes=_freeze(game_data['CLASSES']),
+        enemies=MappingProxyType(enemies),
+        enemy_names=MappingProxyType({floor: frozenset(e['name'] for e in v) for floor, v in enemies.items()}),
+        bosses=MappingProxyType(bosses),
+        hordes=MappingProxyType(hordes),
+        puzzles=MappingProxyType({int(k): _freeze(v) for k, v in game_data['PUZZLES'].items()}),
+        floor_story=MappingProxyType({int(k): v for k, v in game_data['FLOOR_STORY'].items()}),
+        roster=roster,
+        roster_ids=MappingProxyType(roster_ids),
+        digest=digest,
+    )
+
+
+def get_content(path=DATA_FILE):
+    """
+    Return the compiled content for a data file, reloading it only if the file changed.
+    """
+    key = os.path.abspath(path)
+    stat = os.stat(key)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+
+    cached = _cache.get(key)
+    if cached and cached[0] == stamp:
+        return cached[1]
+
+    with _lock:
+        cached = _cache.get(key)
+        if cached and cached[0] == stamp:
+            return cached[1]
+        with open(key, 'rb') as f:
+            raw = f.read()
+        digest = hashlib.sha256(raw).hexdigest()
+        if cached and cached[1].digest == digest:
+            # Touched but unchanged, keep the compiled records
+            content = cached[1]
+        else:
+            content = compile_content(json.loads(raw), digest)
+        _cache[key] = (stamp, content)
+        return content
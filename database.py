@@ -0,0 +1,1328 @@
+"""
+SQLite persistence for saved games.
+
+Connections come from a per-database ``ConnectionPool`` that keeps one open
+connection per running thread, so each thread reuses its connection instead of
+reconnecting on each call, and closes it when the thread ends. Connections are opened once in WAL mode with
+tuned pragmas, and the SQL below lives in module constants so sqlite3's per-connection
+statement cache reuses the prepared statements.
+
+The message log is stored one line per row and each save appends only the new
+lines. Loading fetches the tail the UI shows; older lines are paged in on demand.
+A session keeps only its newest lines (``player.MessageLog``), so a snapshot is
+also taken before they would scroll out; lines one long action writes past the
+buffer are held by the log until that snapshot takes them.
+
+The schema is versioned: ``init_database`` applies whatever entries of
+``MIGRATIONS`` a file has not seen yet, and saves are written with a single UPSERT
+on the unique save name.
+
+Saves are event-sourced: every player action is recorded as a small row with the
+seed it ran with (``record_action``), and the full snapshot row is only rewritten
+every ``SNAPSHOT_EVERY`` actions. ``load_game`` returns the latest snapshot plus the
+actions recorded after it, which ``actions.replay`` re-applies exactly. Each action
+also records the ``actions.RULES_VERSION`` it ran under. Actions recorded under
+other rules would not replay the same, so the load stops before them and reports
+how many it left out as ``stale_events``.
+
+Interactive saves go through a ``SaveQueue`` that coalesces snapshots per save name
+and writes them in batches off the Streamlit thread. Reads flush it first, so they
+always see the latest state. Repeated reads are answered from a ``ReadCache`` that
+every write invalidates for the saves it touched.
+
+With ``single_writer`` every write is handed to one ``DatabaseWriter`` thread,
+which commits the requests of all sessions together, so sessions never contend
+for SQLite's write lock. Reads keep using their own WAL connections.
+
+The game uses ``get_database``, which opens each file once per process (checking
+its schema version that one time) and shares the handle across every session and
+rerun; ``shutdown`` runs at exit to write pending saves and close connections.
+"""
+import atexit
+import copy
+import json
+import os
+import re
+import sqlite3
+import threading
+import weakref
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future
+
+import achievements
+import actions
+import combat
+import general
+import groups
+import metrics
+from achievements import AchievementTracker
+
+
+DB_FILE = "dnd_game.db"
+BUSY_TIMEOUT = 5.0
+STATEMENT_CACHE_SIZE = 256
+FLUSH_INTERVAL = 2.0
+MAX_PENDING = 64
+LOG_TAIL = 50
+LOG_PAGE_SIZE = 20
+SAVE_PAGE_SIZE = 10
+SNAPSHOT_EVERY = 20
+READ_CACHE_SIZE = 256
+MAX_GROUP = 256
+# Set DND_SINGLE_WRITER=1 to send every write through one DatabaseWriter thread
+SINGLE_WRITER = os.environ.get('DND_SINGLE_WRITER') == '1'
+# Set DND_SHARDS=N to spread saves over N database files (see shards.py)
+SHARDS = int(os.environ.get('DND_SHARDS', '1'))
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA foreign_keys=ON",
+)
+
+CREATE_GAME_SAVES = """
+    CREATE TABLE IF NOT EXISTS game_saves (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        save_name TEXT NOT NULL,
+        player_class TEXT,
+        player_image TEXT,
+        health INTEGER,
+        max_health INTEGER,
+        mana INTEGER,
+        max_mana INTEGER,
+        strength INTEGER,
+        agility INTEGER,
+        floor INTEGER,
+        skill_points INTEGER,
+        pending_skill_points BOOLEAN,
+        in_combat BOOLEAN,
+        enemy TEXT,
+        enemy_health INTEGER,
+        in_puzzle BOOLEAN,
+        puzzle_solved BOOLEAN,
+        message_log TEXT,
+        game_over BOOLEAN,
+        fighting_boss BOOLEAN,
+        solved_puzzles TEXT,
+        enemies_defeated INTEGER,
+        defeated_enemies TEXT,
+        encountered_by_floor TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )"""
+
+CREATE_COMBAT_LOGS = """
+    CREATE TABLE IF NOT EXISTS combat_logs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        save_id INTEGER,
+        floor INTEGER,
+        enemy_name TEXT,
+        action TEXT,
+        damage INTEGER,
+        player_health INTEGER,
+        enemy_health INTEGER,
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (save_id) REFERENCES game_saves(id) ON DELETE CASCADE
+    )"""
+
+CREATE_ACHIEVEMENTS = """
+    CREATE TABLE IF NOT EXISTS achievements (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        save_id INTEGER,
+        achievement_type TEXT,
+        achievement_name TEXT,
+        description TEXT,
+        unlocked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (save_id) REFERENCES game_saves(id) ON DELETE CASCADE
+    )"""
+
+UPSERT_SAVE = """
+    INSERT INTO game_saves (
+        player_class, player_image, health, max_health, mana, max_mana,
+        strength, agility, floor, skill_points, pending_skill_points, in_combat,
+        enemy, enemy_health, in_puzzle, puzzle_solved, game_over,
+        fighting_boss, solved_puzzles, enemies_defeated, defeated_enemies, encountered_by_floor,
+        effects, enemy_group, endless, tower_seed, event_seq, save_name
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (save_name) DO UPDATE SET
+        player_class = excluded.player_class,
+        player_image = excluded.player_image,
+        health = excluded.health,
+        max_health = excluded.max_health,
+        mana = excluded.mana,
+        max_mana = excluded.max_mana,
+        strength = excluded.strength,
+        agility = excluded.agility,
+        floor = excluded.floor,
+        skill_points = excluded.skill_points,
+        pending_skill_points = excluded.pending_skill_points,
+        in_combat = excluded.in_combat,
+        enemy = excluded.enemy,
+        enemy_health = excluded.enemy_health,
+        in_puzzle = excluded.in_puzzle,
+        puzzle_solved = excluded.puzzle_solved,
+        game_over = excluded.game_over,
+        fighting_boss = excluded.fighting_boss,
+        solved_puzzles = excluded.solved_puzzles,
+        enemies_defeated = excluded.enemies_defeated,
+        defeated_enemies = excluded.defeated_enemies,
+        encountered_by_floor = excluded.encountered_by_floor,
+        effects = excluded.effects,
+        enemy_group = excluded.enemy_group,
+        endless = excluded.endless,
+        tower_seed = excluded.tower_seed,
+        event_seq = excluded.event_seq,
+        message_log = NULL,
+        updated_at = CURRENT_TIMESTAMP
+    WHERE excluded.event_seq >= game_saves.event_seq
+    RETURNING id"""
+
+CREATE_MESSAGE_LOG = """
+    CREATE TABLE IF NOT EXISTS message_log (
+        save_id INTEGER NOT NULL,
+        seq INTEGER NOT NULL,
+        line TEXT NOT NULL,
+        PRIMARY KEY (save_id, seq),
+        FOREIGN KEY (save_id) REFERENCES game_saves(id) ON DELETE CASCADE
+    ) WITHOUT ROWID"""
+
+CREATE_GAME_EVENTS = """
+    CREATE TABLE IF NOT EXISTS game_events (
+        save_id INTEGER NOT NULL,
+        seq INTEGER NOT NULL,
+        action TEXT NOT NULL,
+        args TEXT NOT NULL,
+        seed INTEGER NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (save_id, seq),
+        FOREIGN KEY (save_id) REFERENCES game_saves(id) ON DELETE CASCADE
+    ) WITHOUT ROWID"""
+
+INSERT_EVENT = """
+    INSERT OR REPLACE INTO game_events (save_id, seq, action, args, seed, rules) VALUES (?, ?, ?, ?, ?, ?)"""
+
+SELECT_EVENTS = """
+    SELECT e.action, e.args, e.seed, e.rules
+    FROM game_events e
+    JOIN game_saves s ON e.save_id = s.id
+    WHERE s.save_name = ? AND e.seq > ?
+    ORDER BY e.seq"""
+
+CREATE_SAVE_SEARCH = """
+    CREATE VIRTUAL TABLE IF NOT EXISTS save_search USING fts5 (
+        save_name, content = 'game_saves', content_rowid = 'id'
+    )"""
+
+# Keep the external-content index in step with game_saves
+SAVE_SEARCH_TRIGGERS = (
+    """CREATE TRIGGER IF NOT EXISTS save_search_insert AFTER INSERT ON game_saves BEGIN
+        INSERT INTO save_search (rowid, save_name) VALUES (new.id, new.save_name);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS save_search_delete AFTER DELETE ON game_saves BEGIN
+        INSERT INTO save_search (save_search, rowid, save_name) VALUES ('delete', old.id, old.save_name);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS save_search_update AFTER UPDATE OF save_name ON game_saves BEGIN
+        INSERT INTO save_search (save_search, rowid, save_name) VALUES ('delete', old.id, old.save_name);
+        INSERT INTO save_search (rowid, save_name) VALUES (new.id, new.save_name);
+    END""",
+)
+
+
+def create_save_search(conn):
+    """Build the FTS5 index of save names, if this SQLite has FTS5"""
+    try:
+        conn.execute(CREATE_SAVE_SEARCH)
+    except sqlite3.OperationalError:
+        # No FTS5 in this build: browse_saves falls back to LIKE
+        return
+    for sql in SAVE_SEARCH_TRIGGERS:
+        conn.execute(sql)
+    conn.execute("INSERT INTO save_search (save_search) VALUES ('rebuild')")
+
+
+def move_legacy_logs(conn):
+    """Move every log still kept in the old JSON column into message_log rows"""
+    rows = conn.execute("SELECT id, message_log FROM game_saves WHERE message_log IS NOT NULL").fetchall()
+    for save_id, log in rows:
+        conn.executemany("INSERT OR IGNORE INTO message_log (save_id, seq, line) VALUES (?, ?, ?)",
+                         ((save_id, seq, line) for seq, line in enumerate(json.loads(log))))
+    conn.execute("UPDATE game_saves SET message_log = NULL WHERE message_log IS NOT NULL")
+
+
+# Each migration upgrades the schema to its version number; the current version
+# is kept in PRAGMA user_version, so existing files are upgraded in place.
+# Steps are SQL strings or functions taking the connection.
+MIGRATIONS = (
+    (1, (CREATE_GAME_SAVES, CREATE_COMBAT_LOGS, CREATE_ACHIEVEMENTS)),
+    (2, (CREATE_MESSAGE_LOG,)),
+    (3, (
+        # Older versions could write several rows per save name, keep the newest
+        "DELETE FROM game_saves WHERE id NOT IN (SELECT MAX(id) FROM game_saves GROUP BY save_name)",
+        "DELETE FROM combat_logs WHERE save_id NOT IN (SELECT id FROM game_saves)",
+        "DELETE FROM achievements WHERE save_id NOT IN (SELECT id FROM game_saves)",
+        "DELETE FROM message_log WHERE save_id NOT IN (SELECT id FROM game_saves)",
+        "DELETE FROM achievements WHERE id NOT IN "
+        "(SELECT MIN(id) FROM achievements GROUP BY save_id, achievement_name)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_game_saves_save_name ON game_saves (save_name)",
+        "CREATE INDEX IF NOT EXISTS idx_game_saves_updated_at ON game_saves (updated_at)",
+        "CREATE INDEX IF NOT EXISTS idx_combat_logs_save_time ON combat_logs (save_id, timestamp)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_achievements_save_name ON achievements (save_id, achievement_name)",
+        "CREATE INDEX IF NOT EXISTS idx_achievements_save_time ON achievements (save_id, unlocked_at)",
+    )),
+    (4, (
+        CREATE_GAME_EVENTS,
+        "ALTER TABLE game_saves ADD COLUMN event_seq INTEGER NOT NULL DEFAULT 0",
+    )),
+    (5, (
+        # One row per combat action, grouped into numbered fights per save
+        "ALTER TABLE combat_logs ADD COLUMN fight INTEGER",
+        "ALTER TABLE combat_logs ADD COLUMN turn INTEGER",
+        "ALTER TABLE combat_logs ADD COLUMN player_class TEXT",
+        "ALTER TABLE combat_logs ADD COLUMN actor TEXT",
+        "ALTER TABLE combat_logs ADD COLUMN skill TEXT",
+        "ALTER TABLE combat_logs ADD COLUMN crit BOOLEAN",
+        "ALTER TABLE combat_logs ADD COLUMN evaded BOOLEAN",
+        "ALTER TABLE combat_logs ADD COLUMN player_health_before INTEGER",
+        "ALTER TABLE combat_logs ADD COLUMN enemy_health_before INTEGER",
+        "CREATE INDEX IF NOT EXISTS idx_combat_logs_save_fight ON combat_logs (save_id, fight)",
+    )),
+    (6, (
+        create_save_search,
+        "CREATE INDEX IF NOT EXISTS idx_game_saves_class_updated_at ON game_saves (player_class, updated_at)",
+    )),
+    (7, (
+        # Status effects of a fight in progress, see effects.py
+        "ALTER TABLE game_saves ADD COLUMN effects TEXT",
+    )),
+    (8, (
+        # Members of a horde being fought, see groups.py
+        "ALTER TABLE game_saves ADD COLUMN enemy_group TEXT",
+    )),
+    (9, (
+        # Endless mode and the seed of the run's generated floors, see tower.py
+        "ALTER TABLE game_saves ADD COLUMN endless INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE game_saves ADD COLUMN tower_seed INTEGER",
+    )),
+    (10, (
+        # The actions.RULES_VERSION an action was recorded under; older rows count as 0
+        "ALTER TABLE game_events ADD COLUMN rules INTEGER NOT NULL DEFAULT 0",
+    )),
+    (11, (
+        # Saves from before migration 2 not played since still hold the whole log as JSON
+        move_legacy_logs,
+    )),
+)
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+SELECT_LOG_LENGTH = "SELECT COALESCE(MAX(seq) + 1, 0) FROM message_log WHERE save_id = ?"
+
+INSERT_LOG_LINE = "INSERT INTO message_log (save_id, seq, line) VALUES (?, ?, ?)"
+
+TRUNCATE_LOG = "DELETE FROM message_log WHERE save_id = ? AND seq >= ?"
+
+SELECT_LOG_TAIL = """
+    SELECT seq, line FROM message_log
+    WHERE save_id = ?
+    ORDER BY seq DESC
+    LIMIT ?"""
+
+SELECT_LOG_PAGE = """
+    SELECT l.seq, l.line
+    FROM message_log l
+    JOIN game_saves s ON l.save_id = s.id
+    WHERE s.save_name = ? AND l.seq < ?
+    ORDER BY l.seq DESC
+    LIMIT ?"""
+
+# Saves whose stored log is missing lines
+LOG_GAPS = """
+    SELECT s.save_name
+    FROM game_saves s
+    JOIN message_log l ON l.save_id = s.id
+    GROUP BY s.id
+    HAVING COUNT(*) != MAX(l.seq) + 1
+    ORDER BY s.save_name"""
+
+# Where a save's combat records stopped: (fight, turn, enemy, action, player health, enemy health)
+SELECT_LAST_COMBAT_EVENT = """
+    SELECT fight, turn, enemy_name, action, player_health, enemy_health
+    FROM combat_logs
+    WHERE save_id = ? AND fight IS NOT NULL
+    ORDER BY fight DESC, id DESC
+    LIMIT 1"""
+
+TOUCH_SAVE = "UPDATE game_saves SET updated_at = CURRENT_TIMESTAMP WHERE id = ?"
+
+INSERT_COMBAT_EVENT = """
+    INSERT INTO combat_logs (
+        save_id, fight, turn, floor, enemy_name, player_class, actor, action, skill,
+        damage, crit, evaded, player_health_before, player_health, enemy_health_before, enemy_health
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+
+# One row per finished fight; rows written before migration 5 have no fight number,
+# and a fight still in progress (or abandoned) has no victory or defeat record
+FIGHTS = """
+    WITH fights AS (
+        SELECT MIN(enemy_name) AS enemy_name,
+               MIN(player_class) AS player_class,
+               MAX(turn) AS turns,
+               SUM(CASE WHEN actor = 'enemy' THEN damage ELSE 0 END) AS damage_taken,
+               MAX(action = 'victory') AS won
+        FROM combat_logs
+        WHERE fight IS NOT NULL
+        GROUP BY save_id, fight
+        HAVING MAX(action IN ('victory', 'defeat')) = 1
+    )"""
+
+DAMAGE_BY_ENEMY = FIGHTS + """
+    SELECT enemy_name, COUNT(*), SUM(damage_taken), AVG(damage_taken)
+    FROM fights
+    GROUP BY enemy_name
+    ORDER BY AVG(damage_taken) DESC"""
+
+TURNS_BY_ENEMY = FIGHTS + """
+    SELECT enemy_name, COUNT(*), AVG(turns)
+    FROM fights
+    GROUP BY enemy_name
+    ORDER BY AVG(turns) DESC"""
+
+KILL_RATE_BY_CLASS = FIGHTS + """
+    SELECT player_class, COUNT(*), SUM(won), AVG(won)
+    FROM fights
+    GROUP BY player_class
+    ORDER BY player_class"""
+
+SELECT_UNLOCKED = "SELECT achievement_name FROM achievements WHERE save_id = ?"
+
+INSERT_ACHIEVEMENT = """
+    INSERT OR IGNORE INTO achievements (save_id, achievement_type, achievement_name, description)
+    VALUES (?, ?, ?, ?)"""
+
+SELECT_SAVE_ID = "SELECT id FROM game_saves WHERE save_name = ?"
+
+SELECT_SAVE = "SELECT * FROM game_saves WHERE save_name = ?"
+
+DELETE_SAVE = "DELETE FROM game_saves WHERE save_name = ?"
+
+LIST_SAVES = """
+    SELECT save_name, player_class, floor, created_at, updated_at
+    FROM game_saves
+    ORDER BY updated_at DESC"""
+
+# Filled in by browse_saves with the active filters
+BROWSE_SAVES = """
+    SELECT save_name, player_class, floor, created_at, updated_at, id
+    FROM game_saves
+    WHERE {where}
+    ORDER BY updated_at DESC, id DESC
+    LIMIT ?"""
+
+HAS_SAVE_SEARCH = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'save_search'"
+
+SELECT_ACHIEVEMENTS = """
+    SELECT a.achievement_name, a.description, a.unlocked_at
+    FROM achievements a
+    JOIN game_saves s ON a.save_id = s.id
+    WHERE s.save_name = ?
+    ORDER BY a.unlocked_at DESC"""
+
+SELECT_COMBAT_HISTORY = """
+    SELECT c.floor, c.enemy_name, c.action, c.damage, c.player_health, c.enemy_health, c.timestamp
+    FROM combat_logs c
+    JOIN game_saves s ON c.save_id = s.id
+    WHERE s.save_name = ?
+    ORDER BY c.id DESC
+    LIMIT ?"""
+
+
+class ConnectionPool:
+    """
+    One reusable SQLite connection per thread for a single database file.
+
+    A thread's connection is closed once the thread has finished, so threads
+    that come and go (Streamlit runs every rerun on a new one) do not leave
+    open connections behind.
+    """
+
+    def __init__(self, db_name):
+        self.db_name = db_name
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._connections = []
+        self._pid = os.getpid()
+
+    def connection(self):
+        """Return this thread's connection, opening it on first use"""
+        if self._pid != os.getpid():
+            # Forked child: never share the parent's SQLite handles
+            self._local = threading.local()
+            self._connections = []
+            self._pid = os.getpid()
+
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.db_name,
+                timeout=BUSY_TIMEOUT,
+                cached_statements=STATEMENT_CACHE_SIZE,
+                check_same_thread=False,
+                factory=metrics.connection_factory(),
+            )
+            for pragma in PRAGMAS:
+                conn.execute(pragma)
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+            weakref.finalize(threading.current_thread(), self._release, conn, self._pid)
+        return conn
+
+    def _release(self, conn, pid):
+        """Close the connection of a thread that has finished"""
+        if pid != os.getpid():
+            # Inherited by a forked child, the parent still owns it
+            return
+        with self._lock:
+            if conn not in self._connections:
+                return
+            self._connections.remove(conn)
+        conn.close()
+
+    def close(self):
+        """Close every connection the pool has opened"""
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(db_name):
+    """Return the process-wide pool for a database file"""
+    key = db_name if db_name == ':memory:' else os.path.abspath(db_name)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(db_name)
+        return pool
+
+
+def close_pools():
+    """Close every pooled connection in the process"""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class ReadCache:
+    """
+    Bounded LRU cache of query results, invalidated per save.
+
+    Entries are filed under the save name they read, or under None for listings
+    that span every save. Each invalidation gives the save a new version so a read
+    that raced a write cannot store what it read from before the write.
+
+    Versions come from one counter and only the ``maxsize`` most recently
+    invalidated saves keep theirs; the others share ``_floor``, the newest version
+    dropped, so a read that started before a drop is not stored either.
+    """
+
+    def __init__(self, maxsize=READ_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._keys = {}
+        self._versions = OrderedDict()
+        self._clock = 0
+        self._floor = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return (True, value) for a cached key, else (False, None)"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, self._entries[key][1]
+            self.misses += 1
+            return False, None
+
+    def version(self, save_name):
+        with self._lock:
+            return self._versions.get(save_name, self._floor)
+
+    def put(self, key, save_name, value, version):
+        """Store a value read at ``version``, unless the save was written since"""
+        with self._lock:
+            if self._versions.get(save_name, self._floor) != version:
+                return
+            self._entries[key] = (save_name, value)
+            self._entries.move_to_end(key)
+            self._keys.setdefault(save_name, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                old_key, (old_save, _) = self._entries.popitem(last=False)
+                self._keys[old_save].discard(old_key)
+
+    def invalidate(self, save_name, listings=True):
+        """Drop everything read from a save, and the listings unless told otherwise"""
+        with self._lock:
+            for name in (save_name, None) if listings else (save_name,):
+                self._bump(name)
+                for key in self._keys.pop(name, ()):
+                    del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            for name in list(self._keys):
+                self._bump(name)
+            self._entries.clear()
+            self._keys.clear()
+
+    def _bump(self, save_name):
+        """Give a save a new version, dropping the oldest once too many are kept (lock held)"""
+        self._clock += 1
+        self._versions[save_name] = self._clock
+        self._versions.move_to_end(save_name)
+        while len(self._versions) > self.maxsize:
+            _, self._floor = self._versions.popitem(last=False)
+
+    def info(self):
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self._entries))
+
+
+class DatabaseWriter:
+    """
+    The only thread that writes to a database file.
+
+    Requests are functions taking a cursor. Whatever has queued up while the
+    previous transaction committed is run in the next one, each request in its own
+    savepoint so a failing request is rolled back without taking the others with it.
+    """
+
+    def __init__(self, pool, max_group=MAX_GROUP):
+        self.pool = pool
+        self.max_group = max_group
+        self.transactions = 0
+        self.requests = 0
+        self._pending = []
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, write):
+        """Queue a write and return a Future for its result"""
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("database writer is closed")
+            self._pending.append((write, future))
+            self._cond.notify()
+        return future
+
+    def run(self, write):
+        """Run a write on the writer thread and wait for its result"""
+        return self.submit(write).result()
+
+    def close(self):
+        """Finish the queued writes and stop the thread"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending or self._closed)
+                if not self._pending:
+                    return
+                group = self._pending[:self.max_group]
+                del self._pending[:self.max_group]
+            self._commit(group)
+
+    def _commit(self, group):
+        conn = self.pool.connection()
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            cursor = conn.cursor()
+            for write, future in group:
+                cursor.execute("SAVEPOINT request")
+                try:
+                    results.append((future, write(cursor), None))
+                    cursor.execute("RELEASE request")
+                except Exception as exc:
+                    cursor.execute("ROLLBACK TO request")
+                    cursor.execute("RELEASE request")
+                    results.append((future, None, exc))
+            conn.commit()
+        except Exception as exc:
+            conn.rollback()
+            for write, future in group:
+                future.set_exception(exc)
+            return
+        self.transactions += 1
+        self.requests += len(group)
+        for future, result, exc in results:
+            if exc is None:
+                future.set_result(result)
+            else:
+                future.set_exception(exc)
+
+
+def _join_log(older, newer):
+    """
+    The log lines of two snapshots of one save, so lines that scrolled out of the
+    session between them are still written when the newer one replaces the older.
+    """
+    lines, base, length = newer
+    old_lines, old_base, old_length = older
+    if not old_base < base <= old_base + old_length:
+        # Nothing older to keep, or a gap no snapshot covers
+        return newer
+    return old_lines[:base - old_base] + tuple(lines[:length]), old_base, base - old_base + length
+
+
+class SaveQueue:
+    """
+    Write-behind queue for saves.
+
+    Per save name it keeps the recorded actions and combat records in order plus
+    only the latest snapshot, and writes everything pending in one transaction, either from a
+    background thread every ``flush_interval`` seconds / once ``max_pending``
+    saves are waiting, or when ``flush`` is called.
+    """
+
+    def __init__(self, database, flush_interval=FLUSH_INTERVAL, max_pending=MAX_PENDING):
+        self.database = database
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.last_error = None
+        self._pending = {}
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+
+    def submit(self, save_name, snapshot=None, actions=(), fights=()):
+        """Queue a snapshot, recorded actions and/or combat records for a save"""
+        with self._cond:
+            self._merge(self._pending, save_name, snapshot, actions, fights)
+            if self._thread is None and not self._closed:
+                self._thread = threading.Thread(target=self._run, name="save-writer", daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+            if len(self._pending) >= self.max_pending:
+                self._cond.notify()
+
+    @staticmethod
+    def _merge(batch, save_name, snapshot=None, actions=(), fights=()):
+        entry = batch.setdefault(save_name, {'save_name': save_name, 'snapshot': None, 'actions': [], 'fights': []})
+        if actions and actions[0][1] == 'start':
+            # A new run under the same name: nothing pending from the old one is kept
+            entry.update(snapshot=None, actions=[], fights=[])
+        if snapshot:
+            previous = entry['snapshot']
+            if previous:
+                # Events recorded by the replaced snapshot must still be evaluated
+                snapshot['events'] = previous['events'] + snapshot['events']
+                snapshot['log'] = _join_log(previous['log'], snapshot['log'])
+            entry['snapshot'] = snapshot
+            entry['fights'].extend(snapshot.pop('fights', ()))
+        entry['actions'].extend(actions)
+        entry['fights'].extend(fights)
+
+    def discard(self, save_name):
+        """Drop pending writes for a save without writing them"""
+        with self._cond:
+            self._pending.pop(save_name, None)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def flush(self, snapshot=None):
+        """
+        Write everything pending in one transaction and return the save ids written.
+
+        An extra ``snapshot`` is written in the same transaction, replacing any
+        pending one for its save name.
+        """
+        with self._flush_lock:
+            with self._cond:
+                batch, self._pending = self._pending, {}
+            if snapshot:
+                self._merge(batch, snapshot['save_name'], snapshot)
+            if not batch:
+                return {}
+            try:
+                # Batches reach the database in the order they were taken, so only
+                # handing one over needs the lock, not waiting for it to commit
+                wait = self.database.submit_batch(batch.values())
+            except Exception:
+                self._requeue(batch)
+                raise
+        try:
+            return wait()
+        except Exception:
+            self._requeue(batch)
+            raise
+
+    def _requeue(self, batch):
+        """Put a failed batch back ahead of anything queued since, so the next flush retries it"""
+        with self._cond:
+            newer, self._pending = self._pending, batch
+            for save_name, entry in newer.items():
+                self._merge(self._pending, save_name, entry['snapshot'], entry['actions'], entry['fights'])
+
+    def close(self):
+        """Stop the background writer and write whatever is still pending"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self.flush()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._closed or len(self._pending) >= self.max_pending,
+                                    timeout=self.flush_interval)
+                if self._closed:
+                    return
+            try:
+                self.flush()
+                self.last_error = None
+            except Exception as exc:
+                self.last_error = exc
+
+
+# Internal plumbing called many times per operation stays untimed
+@metrics.instrument('db', exclude=('connection', 'cached', 'run_write', 'cache_info'))
+class GameDatabase:
+    """SQLite database handler for game persistence"""
+
+    def __init__(self, db_name=DB_FILE, single_writer=False):
+        self.db_name = db_name
+        self.pool = get_pool(db_name)
+        self.save_queue = SaveQueue(self)
+        self.achievements = AchievementTracker()
+        self.read_cache = ReadCache()
+        self.init_database()
+        self.writer = DatabaseWriter(self.pool) if single_writer else None
+
+    def connection(self):
+        """Pooled connection for the calling thread"""
+        return self.pool.connection()
+
+    def run_write(self, write):
+        """
+        Run ``write(cursor)`` in a transaction and return its result.
+
+        In single-writer mode it runs on the writer thread, grouped with other
+        sessions' writes; otherwise on this thread's own connection.
+        """
+        if self.writer is not None:
+            return self.writer.run(write)
+        with self.connection() as conn:
+            return write(conn.cursor())
+
+    def init_database(self):
+        """Initialize database tables, upgrading older files to the current schema"""
+        conn = self.connection()
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version > SCHEMA_VERSION:
+            raise RuntimeError(f"{self.db_name} has schema version {version}, "
+                               f"newer than this code's {SCHEMA_VERSION}")
+        for target, statements in MIGRATIONS:
+            if target <= version:
+                continue
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Another process may have migrated while we waited for the lock
+                version = conn.execute("PRAGMA user_version").fetchone()[0]
+                if target > version:
+                    for sql in statements:
+                        if callable(sql):
+                            sql(conn)
+                        else:
+                            conn.execute(sql)
+                    conn.execute(f"PRAGMA user_version = {target}")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            version = max(version, target)
+        self.save_search = conn.execute(HAS_SAVE_SEARCH).fetchone() is not None
+
+    def close(self):
+        """Write pending saves and stop the background writers"""
+        self.save_queue.close()
+        if self.writer is not None:
+            self.writer.close()
+
+    def snapshot(self, save_name, session_state):
+        """Capture everything a save writes, so it can be written later"""
+        # Convert sets to JSON strings for storage
+        solved_puzzles_json = json.dumps(list(session_state.solved_puzzles))
+        defeated_enemies_json = json.dumps(list(session_state.defeated_enemies))
+        encountered_by_floor_json = json.dumps(session_state.encountered_by_floor)
+        enemy_json = json.dumps(dict(session_state.enemy)) if session_state.enemy else '{}'
+        effects = getattr(session_state, 'effects', None)
+        effects_json = json.dumps(effects) if effects else None
+        group = getattr(session_state, 'enemy_group', None)
+        group_json = json.dumps(group.to_json()) if group is not None else None
+
+        values = (
+            session_state.player_class,
+            session_state.player_image,
+            session_state.health,
+            session_state.max_health,
+            session_state.mana,
+            session_state.max_mana,
+            session_state.strength,
+            session_state.agility,
+            session_state.floor,
+            session_state.skill_points,
+            1 if session_state.pending_skill_points else 0,
+            1 if session_state.in_combat else 0,
+            enemy_json,
+            session_state.enemy_health,
+            1 if session_state.in_puzzle else 0,
+            1 if session_state.puzzle_solved else 0,
+            1 if session_state.game_over else 0,
+            1 if session_state.fighting_boss else 0,
+            solved_puzzles_json,
+            session_state.enemies_defeated,
+            defeated_enemies_json,
+            encountered_by_floor_json,
+            effects_json,
+            group_json,
+            1 if getattr(session_state, 'endless', False) else 0,
+            getattr(session_state, 'tower_seed', None),
+            getattr(session_state, 'event_seq', 0),
+            save_name,
+        )
+        session_state.snapshot_seq = getattr(session_state, 'event_seq', 0)
+        lines, first = session_state.message_log.take()
+
+        return {
+            'save_name': save_name,
+            'values': values,
+            'fights': combat.take_fights(session_state),
+            'events': general.take_events(session_state),
+            'facts': achievements.facts_for(session_state),
+            # The session keeps only the newest lines, so the snapshot copies them
+            'log': (lines, first, len(lines)),
+        }
+
+    def write_batch(self, entries):
+        """Write queued snapshots and actions in one transaction and return their save ids"""
+        return self.submit_batch(entries)()
+
+    def submit_batch(self, entries):
+        """
+        Start writing queued entries and return a function that waits for their save ids.
+
+        Without a single writer the write happens right here; with one, it is
+        queued behind earlier batches and may share their transaction.
+        """
+        entries = list(entries)
+        save_ids = {}
+
+        def write(cursor):
+            self._write_batch(cursor, entries, save_ids)
+
+        def finish(wait):
+            try:
+                wait()
+            except Exception:
+                # Unlocks evaluated for a rolled back transaction were never stored
+                for save_id in save_ids.values():
+                    self.achievements.forget(save_id)
+                raise
+            for entry in entries:
+                # Snapshots, and actions through updated_at, change what the save listings show
+                self.read_cache.invalidate(entry['save_name'], listings=bool(entry['snapshot'] or entry['actions']))
+            return save_ids
+
+        if self.writer is not None:
+            future = self.writer.submit(write)
+            return lambda: finish(future.result)
+        finish(lambda: self.run_write(write))
+        return lambda: save_ids
+
+    def _write_batch(self, cursor, entries, save_ids):
+        for entry in entries:
+            save_name = entry['save_name']
+            snapshot = entry['snapshot']
+            if snapshot and entry['actions'] and entry['actions'][0][1] == 'start':
+                # A new run reusing the name replaces the old one and its history
+                cursor.execute(DELETE_SAVE, (save_name,))
+            row = cursor.execute(UPSERT_SAVE, snapshot['values']).fetchone() if snapshot else None
+            # A snapshot older than the stored one (a retried batch) leaves the row alone
+            current = row is not None
+            if not current:
+                row = cursor.execute(SELECT_SAVE_ID, (save_name,)).fetchone()
+                if not row:
+                    # Deleted since the actions were recorded
+                    continue
+                if entry['actions']:
+                    # Keep "Last played" current between snapshots
+                    cursor.execute(TOUCH_SAVE, (row[0],))
+            save_id = row[0]
+            save_ids[save_name] = save_id
+
+            if entry['actions']:
+                cursor.executemany(INSERT_EVENT, [(save_id,) + action for action in entry['actions']])
+
+            if entry['fights']:
+                self.write_fights(cursor, save_id, entry['fights'])
+
+            if snapshot:
+                if current:
+                    self.append_log(cursor, save_id, *snapshot['log'])
+                self.check_achievements(cursor, save_id, snapshot['events'], snapshot['facts'])
+
+    def append_log(self, cursor, save_id, lines, base, length):
+        """
+        Write the log lines the database does not have yet.
+
+        ``lines[i]`` is line number ``base + i`` of the save's full log; only the
+        first ``length`` entries belong to the snapshot being written.
+        """
+        stored = cursor.execute(SELECT_LOG_LENGTH, (save_id,)).fetchone()[0]
+        end = base + length
+        if end < stored:
+            # The log was restarted, drop what it replaced
+            cursor.execute(TRUNCATE_LOG, (save_id, base))
+            stored = base
+        start = max(stored, base)
+        if start < end:
+            cursor.executemany(INSERT_LOG_LINE, ((save_id, seq, lines[seq - base]) for seq in range(start, end)))
+
+    def write_fights(self, cursor, save_id, fights):
+        """
+        Write combat records, numbering fights after the save's last one.
+
+        A fight is written as it is played, so records that carry on from where the
+        save's unfinished last fight stopped (same enemy and health) continue it.
+        """
+        last = cursor.execute(SELECT_LAST_COMBAT_EVENT, (save_id,)).fetchone()
+        fight, turn = (last[0], last[1] or 0) if last else (0, 0)
+        rows = []
+        for events in fights:
+            first = events[0]
+            if not (last and last[3] not in combat.FIGHT_ENDS and
+                    (last[2], last[4], last[5]) == (first['enemy'], first['player_before'], first['enemy_before'])):
+                fight += 1
+                turn = 0
+            for e in events:
+                if e['actor'] == 'player' and e['action'] not in ('victory', 'effect'):
+                    turn += 1
+                rows.append((
+                    save_id, fight, turn, e['floor'], e['enemy'], e['player_class'], e['actor'],
+                    e['action'], e['skill'], e['damage'], 1 if e['crit'] else 0, 1 if e['evaded'] else 0,
+                    e['player_before'], e['player_after'], e['enemy_before'], e['enemy_after'],
+                ))
+            last = (fight, turn, e['enemy'], e['action'], e['player_after'], e['enemy_after'])
+        cursor.executemany(INSERT_COMBAT_EVENT, rows)
+
+    def save_game(self, save_name, session_state):
+        """Save game state to database right away, along with any queued saves"""
+        save_id = self.save_queue.flush(self.snapshot(save_name, session_state))[save_name]
+
+        # Update session state with save info
+        if hasattr(session_state, 'save_info'):
+            session_state.save_info = {'id': save_id, 'name': save_name}
+
+        return save_id
+
+    def queue_save(self, save_name, session_state):
+        """Queue a save for the background writer, replacing any pending one for the same name"""
+        self.save_queue.submit(save_name, self.snapshot(save_name, session_state))
+
+    def record_action(self, save_name, session_state, action, args, seed, snapshot=False):
+        """
+        Queue one applied action (see actions.py) for a save.
+
+        Only the action and its seed are written, with the combat records it
+        produced, plus a full snapshot every ``SNAPSHOT_EVERY`` actions, when
+        ``snapshot`` is set, or once the game is over, in which case everything is
+        flushed to disk right away. Log lines are written with snapshots: replaying
+        the actions after one brings them back.
+        """
+        event = (session_state.event_seq, action, json.dumps(args), seed, actions.RULES_VERSION)
+        since = session_state.event_seq - getattr(session_state, 'snapshot_seq', 0)
+        full = None
+        # Also before the session's log buffer drops lines no snapshot has copied
+        if snapshot or since >= SNAPSHOT_EVERY or session_state.game_over or session_state.message_log.filling():
+            full = self.snapshot(save_name, session_state)
+        # A snapshot takes the combat records itself. The rest go with the action, so
+        # a fight in progress is kept even if the session ends before the next snapshot
+        fights = combat.take_fights(session_state)
+        self.save_queue.submit(save_name, full, [event], fights)
+        if session_state.game_over:
+            self.flush()
+
+    def get_events(self, save_name, after=0):
+        """Get the recorded (action, args, seed) events of a save numbered above ``after``"""
+        self.save_queue.flush()
+        rows = self.connection().execute(SELECT_EVENTS, (save_name, after)).fetchall()
+        return [(action, json.loads(args), seed) for action, args, seed, rules in rows]
+
+    def flush(self):
+        """Write every queued save now"""
+        return self.save_queue.flush()
+
+    def cached(self, key, save_name, query):
+        """
+        Answer a read from the cache, running ``query`` only on a miss.
+
+        Pending saves are flushed first, which invalidates whatever they change.
+        """
+        self.save_queue.flush()
+        found, value = self.read_cache.get(key)
+        if not found:
+            version = self.read_cache.version(save_name)
+            value = query()
+            self.read_cache.put(key, save_name, value, version)
+        return value
+
+    def cache_info(self):
+        """Hits, misses and size of the read cache"""
+        return self.read_cache.info()
+
+    def check_achievements(self, cursor, save_id, events, facts):
+        """Record achievements newly unlocked by the given game events"""
+        if not events:
+            return
+        if not self.achievements.is_loaded(save_id):
+            cursor.execute(SELECT_UNLOCKED, (save_id,))
+            self.achievements.load(save_id, [name for name, in cursor.fetchall()])
+        unlocked = self.achievements.evaluate(save_id, events, facts)
+        if unlocked:
+            cursor.executemany(INSERT_ACHIEVEMENT, [(save_id,) + achievement for achievement in unlocked])
+
+    def load_game(self, save_name):
+        """Load game state from database"""
+        # The caller owns the sets and lists it gets back
+        return copy.deepcopy(self.cached(('load', save_name), save_name, lambda: self._load_game(save_name)))
+
+    def _load_game(self, save_name):
+        cursor = self.connection().execute(SELECT_SAVE, (save_name,))
+        row = cursor.fetchone()
+
+        if not row:
+            return None
+
+        # Get column names
+        columns = [desc[0] for desc in cursor.description]
+        save_data = dict(zip(columns, row))
+
+        # Parse JSON fields
+        save_data['solved_puzzles'] = set(json.loads(save_data['solved_puzzles'] or '[]'))
+        save_data['defeated_enemies'] = set(json.loads(save_data['defeated_enemies'] or '[]'))
+        save_data['encountered_by_floor'] = json.loads(save_data['encountered_by_floor'] or '{}')
+        save_data['effects'] = json.loads(save_data['effects']) if save_data['effects'] else None
+        if save_data['enemy_group']:
+            save_data['enemy_group'] = groups.EnemyGroup.from_json(json.loads(save_data['enemy_group']))
+
+        # Only the tail of the log is loaded, older lines are paged in on demand
+        tail = self.connection().execute(SELECT_LOG_TAIL, (save_data['id'], LOG_TAIL)).fetchall()
+        if tail:
+            save_data['message_log'] = [line for seq, line in reversed(tail)]
+            save_data['message_log_base'] = tail[-1][0]
+        else:
+            # Saves written before the log table keep it as one JSON column
+            save_data['message_log'] = json.loads(save_data['message_log'] or '[]')
+            save_data['message_log_base'] = 0
+
+        # Parse enemy data
+        enemy_data = json.loads(save_data['enemy'] or '{}')
+        save_data['enemy'] = enemy_data if enemy_data else None
+
+        # Actions recorded after the snapshot, for the caller to replay with actions.replay
+        save_data['snapshot_seq'] = save_data['event_seq']
+        save_data['combat_events'] = []
+        rows = self.connection().execute(SELECT_EVENTS, (save_name, save_data['event_seq'])).fetchall()
+        save_data['replay_events'] = []
+        for action, args, seed, rules in rows:
+            if rules != actions.RULES_VERSION:
+                # Recorded under other rules, so it and everything after it would replay
+                # differently: the game goes on from the snapshot
+                break
+            save_data['replay_events'].append((action, json.loads(args), seed))
+        save_data['stale_events'] = len(rows) - len(save_data['replay_events'])
+
+        # Convert boolean fields
+        bool_fields = ['pending_skill_points', 'in_combat', 'in_puzzle',
+                       'puzzle_solved', 'game_over', 'fighting_boss', 'endless']
+        for field in bool_fields:
+            if field in save_data:
+                save_data[field] = bool(save_data[field])
+
+        return save_data
+
+    def get_message_log(self, save_name, before, limit=LOG_PAGE_SIZE):
+        """Get up to ``limit`` log lines numbered below ``before``, oldest first"""
+        self.save_queue.flush()
+        rows = self.connection().execute(SELECT_LOG_PAGE, (save_name, before, limit)).fetchall()
+        return rows[::-1]
+
+    def log_gaps(self):
+        """Get the names of saves whose stored message log is missing lines"""
+        self.save_queue.flush()
+        return [name for name, in self.connection().execute(LOG_GAPS).fetchall()]
+
+    def delete_game(self, save_name):
+        """Delete a saved game"""
+        self.save_queue.discard(save_name)
+        deleted = self.run_write(lambda cursor: cursor.execute(DELETE_SAVE, (save_name,)).rowcount)
+        self.read_cache.invalidate(save_name)
+        return deleted > 0
+
+    def list_saves(self):
+        """List all saved games"""
+        return list(self.cached(('list',), None, lambda: self.connection().execute(LIST_SAVES).fetchall()))
+
+    def browse_saves(self, limit=SAVE_PAGE_SIZE, after=None, player_class=None, min_floor=None,
+                     max_floor=None, played_since=None, search=None):
+        """
+        Get one page of saves, most recently played first.
+
+        Args:
+            limit (int): Saves per page
+            after (tuple): Cursor returned with the previous page, None for the first
+            player_class (str): Only saves of this class
+            min_floor, max_floor (int): Only saves on floors in this range
+            played_since (str or datetime): Only saves played at or after this UTC time
+            search (str): Words the save name must contain, matched by prefix
+
+        Returns:
+            tuple: (list of (save_name, player_class, floor, created_at, updated_at),
+                    cursor for the next page or None if this is the last)
+        """
+        rows = self.browse_page(limit + 1, after, player_class, min_floor, max_floor, played_since, search)
+        cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            cursor = (rows[-1][4], rows[-1][5])
+        return [row[:5] for row in rows], cursor
+
+    def browse_page(self, limit, after=None, player_class=None, min_floor=None,
+                    max_floor=None, played_since=None, search=None):
+        """Like ``browse_saves``, but rows end with the save id and no cursor is returned"""
+        key = ('browse', limit, after, player_class, min_floor, max_floor, str(played_since), search)
+        return list(self.cached(key, None, lambda: self._browse_page(
+            limit, after, player_class, min_floor, max_floor, played_since, search)))
+
+    def _browse_page(self, limit, after, player_class, min_floor, max_floor, played_since, search):
+        where = []
+        params = []
+        if after:
+            where.append("(updated_at, id) < (?, ?)")
+            params.extend(after)
+        if player_class:
+            where.append("player_class = ?")
+            params.append(player_class)
+        if min_floor is not None:
+            where.append("floor >= ?")
+            params.append(min_floor)
+        if max_floor is not None:
+            where.append("floor <= ?")
+            params.append(max_floor)
+        if played_since is not None:
+            if not isinstance(played_since, str):
+                played_since = played_since.strftime('%Y-%m-%d %H:%M:%S')
+            where.append("updated_at >= ?")
+            params.append(played_since)
+        words = re.findall(r'\w+', search or '')
+        if words and self.save_search:
+            where.append("id IN (SELECT rowid FROM save_search WHERE save_search MATCH ?)")
+            params.append(' '.join(f'"{word}"*' for word in words))
+        elif words:
+            for word in words:
+                where.append("save_name LIKE ?")
+                params.append(f"%{word}%")
+
+        sql = BROWSE_SAVES.format(where=' AND '.join(where) or '1')
+        return self.connection().execute(sql, params + [limit]).fetchall()
+
+    def get_achievements(self, save_name):
+        """Get achievements for a saved game"""
+        return list(self.cached(('achievements', save_name), save_name, lambda: self.connection().execute(
+            SELECT_ACHIEVEMENTS, (save_name,)).fetchall()))
+
+    def get_combat_history(self, save_name, limit=10):
+        """Get combat history for a saved game"""
+        return list(self.cached(('combat', save_name, limit), save_name, lambda: self.connection().execute(
+            SELECT_COMBAT_HISTORY, (save_name, limit)).fetchall()))
+
+    def damage_taken_by_enemy(self):
+        """Get (enemy, fights, total damage taken, average per fight) across all saves"""
+        self.save_queue.flush()
+        return self.connection().execute(DAMAGE_BY_ENEMY).fetchall()
+
+    def turns_by_enemy(self):
+        """Get (enemy, fights, average player turns per fight) across all saves"""
+        self.save_queue.flush()
+        return self.connection().execute(TURNS_BY_ENEMY).fetchall()
+
+    def kill_rate_by_class(self):
+        """Get (class, fights, fights won, win rate) across all saves"""
+        self.save_queue.flush()
+        return self.connection().execute(KILL_RATE_BY_CLASS).fetchall()
+
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+
+def get_database(db_name=DB_FILE, single_writer=SINGLE_WRITER, shards=SHARDS):
+    """
+    Return the process-wide handle for a database file, opening it on first use.
+
+    The schema is checked and migrated only when the handle is created, so later
+    calls (every Streamlit rerun) do no database work. With ``shards`` above 1 the
+    handle is a ``shards.ShardedDatabase`` over that many files next to ``db_name``.
+    ``single_writer`` only applies to the call that creates the handle.
+    """
+    key = (db_name if db_name == ':memory:' else os.path.abspath(db_name), shards)
+    database = _databases.get(key)
+    if database is not None:
+        return database
+    with _databases_lock:
+        database = _databases.get(key)
+        if database is None:
+            if not _databases:
+                atexit.register(shutdown)
+            if shards > 1:
+                from shards import ShardedDatabase
+                database = ShardedDatabase(db_name, shards, single_writer)
+            else:
+                database = GameDatabase(db_name, single_writer)
+            _databases[key] = database
+        return database
+
+
+def shutdown():
+    """Write every pending save and close all connections in the process"""
+    with _databases_lock:
+        databases = list(_databases.values())
+        _databases.clear()
+    for database in databases:
+        database.close()
+    close_pools()
@@ -0,0 +1,131 @@
+"""
+Status effects.
+
+Skills (and enemies) name an ``effect``; the ones in ``SOURCES`` put a timed status
+on their target:
+
+    burn, poison    damage at each of the target's turns, stacking up to max_stacks
+    freeze, stun    the target loses its turns; a new one extends, never adds
+
+Each side of a fight keeps the running total of its damage over time and, for
+every status that makes it lose turns, the turn it lasts until. Damage stacks are
+kept on a heap ordered by the turn they expire, so a turn costs one lookup plus
+a heap pop per stack that ends, O(log n) in the number of active stacks, instead
+of a pass over all of them.
+
+The state is plain lists and dicts (``state.effects``), so it is saved with the
+game as JSON. ``combat.py`` ticks it; ``simulator.py`` runs the same rules on
+arrays of fights.
+"""
+import heapq
+
+
+# kind "damage": power is the share of the hit's base damage dealt each turn
+EFFECTS = {
+    'burn': {'kind': 'damage', 'duration': 3, 'power': 0.25, 'max_stacks': 3, 'label': "burning"},
+    'poison': {'kind': 'damage', 'duration': 4, 'power': 0.2, 'max_stacks': 5, 'label': "poisoned"},
+    'freeze': {'kind': 'hold', 'duration': 1, 'label': "frozen"},
+    'stun': {'kind': 'hold', 'duration': 1, 'label': "stunned"},
+}
+
+# Skill or enemy "effect" value -> (status, default chance to apply on a hit)
+SOURCES = {
+    'burn': ('burn', 1.0),
+    'poison': ('poison', 1.0),
+    'freeze': ('freeze', 1.0),
+    'stun_chance': ('stun', 0.3),
+    'stun_aoe': ('stun', 0.5),
+}
+
+
+def new_side():
+    return {'damage': 0, 'stacks': {}, 'until': {}, 'heap': [], 'seq': 0}
+
+
+def new_effects():
+    """
+    No effects on either side, at turn 0.
+    """
+    return {'turn': 0, 'player': new_side(), 'enemy': new_side()}
+
+
+def source(record):
+    """
+    The (status, chance) a skill or enemy record inflicts on a hit, or None.
+    """
+    if record.get('effect') not in SOURCES:
+        return None
+    status, chance = SOURCES[record['effect']]
+    return status, record.get('effect_chance', chance)
+
+
+def tick_damage(status, base_damage):
+    """
+    Damage per turn of one stack of a damage status caused by a hit of ``base_damage``.
+    """
+    return max(1, int(base_damage * EFFECTS[status]['power']))
+
+
+def inflict(effects, target, status, base_damage=0):
+    """
+    Put ``status`` on ``target`` ('player' or 'enemy'), starting with its next turn.
+
+    Returns:
+        bool: False if it already has the maximum stacks of that status
+    """
+    info = EFFECTS[status]
+    side = effects[target]
+    expires = effects['turn'] + 1 + info['duration']
+    if info['kind'] == 'hold':
+        side['until'][status] = max(side['until'].get(status, 0), expires)
+        return True
+
+    if side['stacks'].get(status, 0) >= info['max_stacks']:
+        return False
+    damage = tick_damage(status, base_damage)
+    side['seq'] += 1
+    heapq.heappush(side['heap'], [expires, side['seq'], status, damage])
+    side['damage'] += damage
+    side['stacks'][status] = side['stacks'].get(status, 0) + 1
+    return True
+
+
+def held(effects, target, turn):
+    """
+    The status that makes ``target`` lose its turn ``turn``, or None.
+    """
+    for status, until in effects[target]['until'].items():
+        if until > turn:
+            return status
+    return None
+
+
+def expire(effects, target, turn):
+    """
+    Remove the stacks on ``target`` that ended by ``turn``.
+
+    Returns:
+        list: Damage statuses that have no stacks left
+    """
+    side = effects[target]
+    heap = side['heap']
+    ended = []
+    while heap and heap[0][0] <= turn:
+        _, _, status, damage = heapq.heappop(heap)
+        side['damage'] -= damage
+        side['stacks'][status] -= 1
+        if not side['stacks'][status]:
+            del side['stacks'][status]
+            ended.append(status)
+    for status in [status for status, until in side['until'].items() if until <= turn]:
+        del side['until'][status]
+    return ended
+
+
+def active(effects, target):
+    """
+    Names of the statuses on ``target`` for its next turn, with stack counts, for display.
+    """
+    side = effects[target]
+    names = [status if count == 1 else f"{status} x{count}" for status, count in side['stacks'].items()]
+    return names + [status for status, until in side['until'].items() if until > effects['turn'] + 1]
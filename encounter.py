@@ -1,6 +1,13 @@
-def encounter_enemy(session_state, nextfloor, maxfloor, ENEMIES, random):
+import effects
+import groups
+
+
+def encounter_enemy(session_state, nextfloor, maxfloor, ENEMIES, random, enemy_names=None):
     """
     Attempts to trigger a random encounter on the current floor.
+
+    ``enemy_names`` optionally maps each floor to the set of its enemy names, so the
+    defeated-enemy filter can be skipped when none of them has been beaten yet.
     """
     if random.random() < 0.7:  
         enemy_list = ENEMIES.get(session_state.floor, [])
@@ -9,10 +16,13 @@ def encounter_enemy(session_state, nextfloor, maxfloor, ENEMIES, random):
             return False
         
         # Filter out defeated enemies
-        available_enemies = [
-            e for e in enemy_list 
-            if e['name'] not in session_state.defeated_enemies
-        ]
+        if enemy_names is not None and enemy_names[session_state.floor].isdisjoint(session_state.defeated_enemies):
+            available_enemies = enemy_list
+        else:
+            available_enemies = [
+                e for e in enemy_list 
+                if e['name'] not in session_state.defeated_enemies
+            ]
 
         if not available_enemies:
             if session_state.floor < maxfloor:
@@ -26,7 +36,9 @@ def encounter_enemy(session_state, nextfloor, maxfloor, ENEMIES, random):
 
         enemy = random.choice(available_enemies)
         session_state.enemy = enemy
+        session_state.enemy_group = None
         session_state.enemy_health = enemy["health"]
+        session_state.effects = effects.new_effects()
         session_state.in_combat = True
         session_state.message_log.append(f"A wild {enemy['name']} appears!")
         return True
@@ -42,12 +54,27 @@ def start_boss(session_state, bosses):
         session_state.fighting_boss = True
         session_state.in_combat = True
         session_state.enemy = boss
+        session_state.enemy_group = None
         session_state.enemy_health = boss["health"]
+        session_state.effects = effects.new_effects()
         session_state.message_log.append(f"Boss {boss['name']} appears! {boss.get('description','')}")
         if "image url" in boss:
             session_state.message_log.append(f"![Boss]({boss['image url']})")
 
 
+def start_horde(session_state, horde):
+    """
+    Starts a fight against every member of a horde at once.
+    """
+    group = groups.EnemyGroup.from_horde(horde)
+    session_state.enemy_group = group
+    session_state.enemy = groups.summary(horde, group)
+    session_state.enemy_health = group.remaining()
+    session_state.effects = effects.new_effects()
+    session_state.in_combat = True
+    session_state.message_log.append(f"A {horde['name']} of {len(group)} appears! {horde.get('description', '')}".rstrip())
+
+
 def start_puzzle(session_state, PUZZLE):
     """
     Initiates a puzzle encounter if the current floor has an unsolved puzzle.
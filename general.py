@@ -11,10 +11,12 @@ def init_game(session_state, floor):
         floor=0,
         in_combat=False,
         enemy=None,
+        enemy_group=None,
         enemy_health=0,
         in_puzzle=False,
         puzzle_solved=False,
         message_log=[floor],
+        message_log_base=0,
         game_over=False,
         skill_points=0,
         pending_skill_points=False,
@@ -22,45 +24,57 @@ def init_game(session_state, floor):
         solved_puzzles=set(),
         enemies_defeated=0,
         defeated_enemies=set(),
+        pending_events=[],
+        combat_events=[],
+        effects=None,
+        endless=False,
+        tower_seed=None,
+        event_seq=0,
+        snapshot_seq=0,
     )
 
 
-def next_floor(session_state, floor_story, MAX_FLOOR):
+def emit_event(session_state, event, value=None):
+    """
+    Record a game event (see achievements.py) for the next save to evaluate.
+    """
+    events = getattr(session_state, 'pending_events', None)
+    if events is None:
+        events = session_state.pending_events = []
+    events.append((event, value))
 
-    if session_state.floor < MAX_FLOOR:
-        session_state.floor += 1
-        session_state.enemies_defeated = 0
-        session_state.message_log.append(f"You advance to floor {session_state.floor}.")
-        session_state.message_log.append(floor_story[session_state.floor])
-        session_state.in_combat = False
-        session_state.enemy = None
-        session_state.enemy_health = 0
-        session_state.in_puzzle = False
-        session_state.puzzle_solved = False
-        session_state.fighting_boss = False
-    else:
-        session_state.message_log.append("You have reached the top of the tower!")
-        session_state.game_over = True
+
+def take_events(session_state):
+    """
+    Return the events recorded since the last call and start a new list.
+    """
+    events = getattr(session_state, 'pending_events', None) or []
+    session_state.pending_events = []
+    return events
 
 
-def handle_victory(session_state, encounter, bosses, BASE_SKILL_POINTS):
+def handle_victory(session_state, encounter, bosses, BASE_SKILL_POINTS, nextfloor):
 
     enemy_name = session_state.enemy['name']
     session_state.defeated_enemies.add(enemy_name)
+    session_state.pending_skill_points = True
+    session_state.in_combat = False
+    session_state.enemy = None
+    session_state.enemy_group = None
+    session_state.enemy_health = 0
+    session_state.effects = None
     
     if session_state.fighting_boss:
+        emit_event(session_state, 'boss_slain', enemy_name)
         session_state.message_log.append(f"You defeated the boss {enemy_name}!")
         session_state.skill_points += BASE_SKILL_POINTS * 2
         session_state.fighting_boss = False
-        next_floor(session_state, {}, 10)  # Empty floor_story since we handle messages in main
+        nextfloor()
     else:
         session_state.message_log.append(f"You defeated the {enemy_name}!")
+        emit_event(session_state, 'enemy_defeated', enemy_name)
         session_state.enemies_defeated += 1
         session_state.skill_points += BASE_SKILL_POINTS
+        # Started last, so the fight is not cleared again
         if session_state.enemies_defeated >= 3:
             encounter.start_boss(session_state, bosses)
-
-    session_state.pending_skill_points = True
-    session_state.in_combat = False
-    session_state.enemy = None
-    session_state.enemy_health = 0
\ No newline at end of file
@@ -0,0 +1,319 @@
+"""
+Load test for the game logic and database.
+
+Runs scripted players the way the Streamlit UI drives the game: every action goes
+through ``actions.apply`` and ``GameDatabase.record_action``, with regular full
+saves and reloads. Players run on threads inside several processes against a
+temporary database, and the report gives throughput and p50/p95/p99 latency per
+operation (named after the UI handlers in dnd.py). Afterwards every save's stored
+message log is checked for missing lines, and the run fails if any has a gap or
+if one of the ``CHECKS`` run beforehand fails or an operation never ran.
+
+Usage:
+    python loadtest.py [--players 1000] [--processes 4] [--threads 16] [--actions 100]
+                       [--save-every 25] [--shards 1] [--single-writer] [--json]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+import actions
+import combat
+import database
+import player
+import tower
+from content import DATA_FILE, get_content
+
+
+PUZZLE_SUCCESS = 0.7   # chance a player knows the answer
+REST_BELOW = 0.4       # rest when health drops under this share of max health
+REST = 0.1             # chance a player rests anyway; skill points top health up after each fight
+AUTO_BATTLE = 0.1      # chance a player auto-battles the rest of a fight
+
+# What the UI calls each action
+OPERATIONS = {
+    'start': 'start_game',
+    'allocate': 'apply_skill_points',
+    'attack': 'player_attack',
+    'auto': 'auto_battle',
+    'answer': 'solve_puzzle',
+    'explore': 'try_encounter',
+    'rest': 'rest',
+}
+
+
+def choose_action(state, content, rng):
+    """The next (action, args) a scripted player takes"""
+    if state.pending_skill_points:
+        return 'allocate', {'strength': state.skill_points}
+    if state.in_puzzle:
+        answer = tower.for_state(state, content).puzzles[state.floor]['answer'] if rng.random() < PUZZLE_SUCCESS else 'no idea'
+        return 'answer', {'text': answer}
+    if state.in_combat:
+        if rng.random() < AUTO_BATTLE:
+            return 'auto', {'policy': 'skills'}
+        skills = content.classes[state.player_class]['skills']
+        return 'attack', {'skill': combat.choose_skill(skills, state.mana, 'skills')}
+    if state.health < state.max_health * REST_BELOW or rng.random() < REST:
+        return 'rest', {}
+    return 'explore', {}
+
+
+def check_legacy_log(content):
+    """A save from before the message_log table, with more lines than a session keeps, loads and saves whole"""
+    lines = [f"Legacy line {i}" for i in range(player.LOG_LINES + 30)]
+    state = actions.new_state(content)
+    state.update(message_log=lines, message_log_base=10)
+    if (state.message_log_base, state.message_log[0]) != (40, lines[30]):
+        return f"a loaded log longer than the session keeps starts at {state.message_log_base}, expected 40"
+
+    with tempfile.TemporaryDirectory(prefix="dnd-loadtest-") as tmpdir:
+        db_name = os.path.join(tmpdir, "legacy.db")
+        db = database.GameDatabase(db_name)
+        state = actions.new_state(content)
+        actions.apply(state, content, 'start', {'player_class': next(iter(content.classes))}, 0)
+        db.save_game('legacy', state)
+        db.close()
+        # Back to schema 10, when the log could still be a JSON column
+        conn = sqlite3.connect(db_name)
+        with conn:
+            conn.execute("DELETE FROM message_log")
+            conn.execute("UPDATE game_saves SET message_log = ?", (json.dumps(lines),))
+            conn.execute("PRAGMA user_version = 10")
+        conn.close()
+
+        db = database.GameDatabase(db_name)
+        save_data = db.load_game('legacy')
+        events = save_data.pop('replay_events')
+        save_data.pop('stale_events')
+        state = actions.new_state(content)
+        state.update({key: value for key, value in save_data.items()
+                      if key not in ('id', 'save_name', 'created_at', 'updated_at')})
+        actions.replay(state, content, events)
+        state.message_log.mark()
+        state.message_log.append("New line")
+        db.save_game('legacy', state)
+        stored = db.get_message_log('legacy', len(lines) + 1, len(lines) + 1)
+        db.close()
+    expected = list(enumerate(lines + ["New line"]))
+    if [tuple(row) for row in stored] != expected:
+        return f"legacy log stored as {len(stored)} lines, first {stored[:1]}, expected {len(expected)}"
+    return None
+
+
+def check_group_formulas(content):
+    """A group's members evade and hit exactly like a single enemy with the same stats"""
+    agility = np.arange(0, 121)
+    strength = np.arange(0, 121)
+    for player_agility in range(0, 121, 3):
+        chances = combat.evasion_chances(player_agility, agility)
+        damages = combat.enemy_damages(strength, player_agility)
+        for a, chance in zip(agility.tolist(), chances.tolist()):
+            if chance != combat.evasion_chance(player_agility, a):
+                return f"evasion_chances({player_agility}, {a}) is {chance}, evasion_chance disagrees"
+        for power, damage in zip(strength.tolist(), damages.tolist()):
+            if damage != combat.enemy_damage(power, player_agility):
+                return f"enemy_damages({power}, {player_agility}) is {damage}, enemy_damage disagrees"
+    return None
+
+
+# Run before the load; each returns what went wrong, or None
+CHECKS = (check_legacy_log, check_group_formulas)
+
+
+class Recorder:
+    """Latencies and errors per operation for one process"""
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+
+    def time(self, operation, call):
+        start = time.perf_counter()
+        try:
+            return call()
+        except Exception as exc:
+            self.errors.setdefault(operation, []).append(repr(exc))
+        finally:
+            self.latencies.setdefault(operation, []).append(time.perf_counter() - start)
+
+
+def play(db, content, recorder, save_name, seed, n_actions, save_every):
+    """One scripted session: start, play, save and load along the way"""
+    rng = random.Random(seed)
+    state = actions.new_state(content)
+
+    def step(action, args, snapshot=False):
+        action_seed = rng.getrandbits(32)
+        actions.apply(state, content, action, args, action_seed)
+        db.record_action(save_name, state, action, args, action_seed, snapshot)
+
+    recorder.time('start_game', lambda: step('start', {'player_class': rng.choice(list(content.classes))},
+                                             snapshot=True))
+    for i in range(1, n_actions + 1):
+        if state.game_over:
+            break
+        action, args = choose_action(state, content, rng)
+        recorder.time(OPERATIONS[action], lambda: step(action, args))
+        if i % save_every == 0:
+            recorder.time('save_game', lambda: db.save_game(save_name, state))
+            recorder.time('load_game', lambda: db.load_game(save_name))
+    recorder.time('save_game', lambda: db.save_game(save_name, state))
+
+
+def run_process(db_name, first, count, threads, n_actions, save_every, seed, shards, single_writer, data):
+    """Play ``count`` sessions on a thread pool; returns this process's Recorder data"""
+    content = get_content(data)
+    db = database.get_database(db_name, single_writer, shards)
+    recorder = Recorder()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        sessions = [pool.submit(play, db, content, recorder, f"player_{number}", seed + number, n_actions, save_every)
+                    for number in range(first, first + count)]
+    database.shutdown()
+    for session in sessions:
+        # A script bug should fail the run, not disappear into the pool
+        session.result()
+    return recorder.latencies, recorder.errors
+
+
+def percentiles(values):
+    """p50, p95 and p99 of a list of latencies"""
+    if len(values) == 1:
+        return values * 3
+    cuts = statistics.quantiles(values, n=100, method='inclusive')
+    return cuts[49], cuts[94], cuts[98]
+
+
+def run(players=1000, processes=4, threads=16, n_actions=100, save_every=25, seed=0,
+        shards=1, single_writer=False, data=DATA_FILE, db_name=None):
+    """
+    Run the load test and return its report.
+
+    Uses a fresh temporary database unless ``db_name`` is given.
+    """
+    content = get_content(data)
+    failed_checks = [f"{check.__name__}: {problem}" for check in CHECKS
+                     for problem in [check(content)] if problem]
+
+    tmpdir = None
+    if db_name is None:
+        tmpdir = tempfile.mkdtemp(prefix="dnd-loadtest-")
+        db_name = os.path.join(tmpdir, "loadtest.db")
+    # Create the schema once, before the workers race to do it
+    database.get_database(db_name, False, shards)
+    database.shutdown()
+
+    processes = max(1, min(processes, players))
+    share, extra = divmod(players, processes)
+    jobs = []
+    first = 0
+    for i in range(processes):
+        count = share + (i < extra)
+        jobs.append((db_name, first, count, threads, n_actions, save_every, seed, shards, single_writer, data))
+        first += count
+
+    latencies = {}
+    errors = {}
+    start = time.perf_counter()
+    try:
+        with ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn')) as pool:
+            for process_latencies, process_errors in pool.map(run_process, *zip(*jobs)):
+                for operation, values in process_latencies.items():
+                    latencies.setdefault(operation, []).extend(values)
+                for operation, messages in process_errors.items():
+                    errors.setdefault(operation, []).extend(messages)
+        elapsed = time.perf_counter() - start
+        # Lines lost between the session's log buffer and the database
+        log_gaps = database.get_database(db_name, False, shards).log_gaps()
+        database.shutdown()
+    finally:
+        if tmpdir:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    report = {
+        'players': players,
+        'processes': processes,
+        'threads': threads,
+        'shards': shards,
+        'single_writer': single_writer,
+        'seconds': elapsed,
+        'log_gaps': log_gaps,
+        'failed_checks': failed_checks,
+        'operations': {},
+    }
+    # A scripted operation that never ran was not load tested
+    for operation in sorted(set(OPERATIONS.values()) - set(latencies)):
+        failed_checks.append(f"no {operation} operations were played")
+    for operation, values in sorted(latencies.items()):
+        p50, p95, p99 = percentiles(values)
+        report['operations'][operation] = {
+            'count': len(values),
+            'errors': len(errors.get(operation, ())),
+            'per_second': len(values) / elapsed,
+            'p50_ms': p50 * 1000,
+            'p95_ms': p95 * 1000,
+            'p99_ms': p99 * 1000,
+            'max_ms': max(values) * 1000,
+        }
+    report['first_errors'] = {operation: messages[:3] for operation, messages in errors.items()}
+    return report
+
+
+def format_report(report):
+    """Render a load test report as a plain-text table"""
+    total = sum(row['count'] for row in report['operations'].values())
+    lines = [
+        f"{report['players']} players on {report['processes']} processes x {report['threads']} threads, "
+        f"{report['shards']} shard(s){', single writer' if report['single_writer'] else ''}: "
+        f"{total} operations in {report['seconds']:.1f}s ({total / report['seconds']:.0f}/s)",
+        f"{'Operation':<20} {'Count':>8} {'Errors':>6} {'Ops/s':>9} {'p50 ms':>8} {'p95 ms':>8} "
+        f"{'p99 ms':>8} {'max ms':>8}",
+    ]
+    for operation, row in report['operations'].items():
+        lines.append(f"{operation:<20} {row['count']:>8} {row['errors']:>6} {row['per_second']:>9.0f} "
+                     f"{row['p50_ms']:>8.2f} {row['p95_ms']:>8.2f} {row['p99_ms']:>8.2f} {row['max_ms']:>8.2f}")
+    for operation, messages in report['first_errors'].items():
+        lines.append(f"{operation} errors, e.g. {messages[0]}")
+    if report['log_gaps']:
+        lines.append(f"{len(report['log_gaps'])} saves are missing message log lines, "
+                     f"e.g. {report['log_gaps'][0]}")
+    for problem in report['failed_checks']:
+        lines.append(f"Check failed: {problem}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate many concurrent players against a temporary database.")
+    parser.add_argument('--players', type=int, default=1000)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=16, help="players played at once per process")
+    parser.add_argument('--actions', type=int, default=100, help="actions per player")
+    parser.add_argument('--save-every', type=int, default=25, help="full save and reload every N actions")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--shards', type=int, default=1)
+    parser.add_argument('--single-writer', action='store_true')
+    parser.add_argument('--data', default=DATA_FILE)
+    parser.add_argument('--db', default=None, help="database to use instead of a temporary one")
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    args = parser.parse_args(argv)
+
+    report = run(args.players, args.processes, args.threads, args.actions, args.save_every, args.seed,
+                 args.shards, args.single_writer, args.data, args.db)
+    print(json.dumps(report, indent=2) if args.json else format_report(report))
+    if report['log_gaps'] or report['failed_checks']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
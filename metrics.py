@@ -0,0 +1,323 @@
+"""
+Timers, counters and profiling for the game.
+
+Action handlers and ``GameDatabase`` methods are wrapped with ``timed``, and
+blocks such as a whole Streamlit rerun with ``timer``. Each records a call count,
+error count, total and max time and a latency histogram per operation: two
+``perf_counter`` calls and a dict update under a lock, in ``registry``.
+
+Everything is configured from the environment so the game needs no flags:
+
+    DND_METRICS_PORT=9108       serve Prometheus text on http://localhost:9108/metrics
+    DND_METRICS_JSON=FILE       append a JSON snapshot to FILE every DND_METRICS_INTERVAL
+                                seconds (default 10), rolling over to FILE.1 past 10 MB
+    DND_SLOW_QUERY_MS=50        time every SQL statement and log the ones slower than this
+    DND_PROFILE=FILE            cProfile the actions of the first session to act and
+                                write the stats to FILE (read with ``python -m pstats FILE``)
+"""
+import atexit
+import cProfile
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from sqlite3 import Connection, Cursor
+
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+JSON_INTERVAL = float(os.environ.get('DND_METRICS_INTERVAL', '10'))
+JSON_MAX_BYTES = 10 * 1024 * 1024
+SLOW_QUERIES_KEPT = 100
+
+SLOW_QUERY_SECONDS = (float(os.environ['DND_SLOW_QUERY_MS']) / 1000
+                      if os.environ.get('DND_SLOW_QUERY_MS') else None)
+
+slow_query_log = logging.getLogger('dnd.slow_query')
+
+
+class Metrics:
+    """Per-operation call counts, errors and latency histograms"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.started = time.time()
+        self._operations = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+        self.slow_queries = deque(maxlen=SLOW_QUERIES_KEPT)
+
+    def observe(self, operation, seconds, error=False):
+        """Record one call of ``operation`` that took ``seconds``"""
+        with self._lock:
+            stats = self._operations.get(operation)
+            if stats is None:
+                stats = self._operations[operation] = {
+                    'count': 0, 'errors': 0, 'seconds': 0.0, 'max': 0.0, 'buckets': [0] * len(self.buckets)}
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            if seconds > stats['max']:
+                stats['max'] = seconds
+            if error:
+                stats['errors'] += 1
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    stats['buckets'][i] += 1
+                    break
+
+    def count(self, counter, amount=1):
+        """Add to a plain counter"""
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + amount
+
+    def slow_query(self, sql, seconds):
+        self.count('slow_queries')
+        sql = ' '.join(sql.split())
+        self.slow_queries.append((time.time(), seconds, sql))
+        slow_query_log.warning("%.1f ms: %s", seconds * 1000, sql)
+
+    def snapshot(self):
+        """A JSON-ready copy of everything recorded so far"""
+        with self._lock:
+            operations = {name: dict(stats, buckets=list(stats['buckets']))
+                          for name, stats in self._operations.items()}
+            counters = dict(self._counters)
+        return {
+            'time': time.time(),
+            'uptime': time.time() - self.started,
+            'operations': operations,
+            'counters': counters,
+            'slow_queries': [{'time': at, 'ms': seconds * 1000, 'sql': sql}
+                             for at, seconds, sql in list(self.slow_queries)],
+        }
+
+    def reset(self):
+        with self._lock:
+            self._operations.clear()
+            self._counters.clear()
+            self.slow_queries.clear()
+
+    def prometheus(self):
+        """Everything recorded so far in the Prometheus text format"""
+        data = self.snapshot()
+        lines = [
+            "# HELP dnd_operation_seconds Time spent in game actions and database calls.",
+            "# TYPE dnd_operation_seconds histogram",
+        ]
+        for name, stats in sorted(data['operations'].items()):
+            cumulative = 0
+            for bound, hits in zip(self.buckets, stats['buckets']):
+                cumulative += hits
+                lines.append(f'dnd_operation_seconds_bucket{{operation="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'dnd_operation_seconds_bucket{{operation="{name}",le="+Inf"}} {stats["count"]}')
+            lines.append(f'dnd_operation_seconds_sum{{operation="{name}"}} {stats["seconds"]}')
+            lines.append(f'dnd_operation_seconds_count{{operation="{name}"}} {stats["count"]}')
+        lines += [
+            "# HELP dnd_operation_errors_total Calls that raised an exception.",
+            "# TYPE dnd_operation_errors_total counter",
+        ]
+        for name, stats in sorted(data['operations'].items()):
+            lines.append(f'dnd_operation_errors_total{{operation="{name}"}} {stats["errors"]}')
+        for name, value in sorted(data['counters'].items()):
+            lines.append(f"# TYPE dnd_{name}_total counter")
+            lines.append(f"dnd_{name}_total {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Metrics()
+
+
+@contextmanager
+def timer(operation, ok=()):
+    """Record the block under ``operation``; exceptions of the ``ok`` types do not count as errors"""
+    start = time.perf_counter()
+    error = True
+    try:
+        yield
+        error = False
+    except ok:
+        error = False
+        raise
+    finally:
+        registry.observe(operation, time.perf_counter() - start, error)
+
+
+def timed(operation, ok=()):
+    """Decorator recording every call of the function under ``operation``, see ``timer``"""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            error = True
+            try:
+                result = func(*args, **kwargs)
+                error = False
+                return result
+            except ok:
+                error = False
+                raise
+            finally:
+                registry.observe(operation, time.perf_counter() - start, error)
+        return wrapper
+    return decorate
+
+
+def instrument(prefix, exclude=()):
+    """Class decorator applying ``timed`` to every public method as ``prefix.method``"""
+    def decorate(cls):
+        for name, value in list(vars(cls).items()):
+            if callable(value) and not name.startswith('_') and name not in exclude:
+                setattr(cls, name, timed(f"{prefix}.{name}")(value))
+        return cls
+    return decorate
+
+
+class TimedCursor(Cursor):
+    """Cursor that reports statements slower than SLOW_QUERY_SECONDS"""
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            elapsed = time.perf_counter() - start
+            if elapsed > SLOW_QUERY_SECONDS:
+                registry.slow_query(sql, elapsed)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            elapsed = time.perf_counter() - start
+            if elapsed > SLOW_QUERY_SECONDS:
+                registry.slow_query(sql, elapsed)
+
+
+class TimedConnection(Connection):
+    """Connection whose statements all go through TimedCursor"""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def connection_factory():
+    """The sqlite3 connection class to open database connections with"""
+    return TimedConnection if SLOW_QUERY_SECONDS is not None else Connection
+
+
+class SessionProfiler:
+    """cProfile capture of one session's actions, written to ``path`` after each"""
+
+    def __init__(self, path):
+        self.path = path
+        self.owner = None
+        self.profile = cProfile.Profile()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def capture(self, session):
+        with self._lock:
+            if self.owner is None:
+                self.owner = session
+        if self.owner != session:
+            yield
+            return
+        self.profile.enable()
+        try:
+            yield
+        finally:
+            self.profile.disable()
+            self.profile.dump_stats(self.path)
+
+
+profiler = SessionProfiler(os.environ['DND_PROFILE']) if os.environ.get('DND_PROFILE') else None
+
+
+@contextmanager
+def profile(session):
+    """Profile the block if profiling is on and ``session`` is the profiled one"""
+    if profiler is None:
+        yield
+    else:
+        with profiler.capture(session):
+            yield
+
+
+class JsonExporter:
+    """Appends a snapshot to a JSON-lines file at an interval, rolling it over when it grows too big"""
+
+    def __init__(self, path, interval=JSON_INTERVAL, max_bytes=JSON_MAX_BYTES):
+        self.path = path
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="metrics-json", daemon=True)
+        self._thread.start()
+
+    def write(self):
+        if os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+            os.replace(self.path, self.path + '.1')
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(registry.snapshot()) + "\n")
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.write()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+
+class _PrometheusHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.prometheus().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_prometheus(port, host='127.0.0.1'):
+    """Serve /metrics on a background thread and return the server"""
+    server = ThreadingHTTPServer((host, port), _PrometheusHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+
+_exporters_started = False
+_exporters_lock = threading.Lock()
+
+
+def start_exporters():
+    """Start the exporters the environment asks for, once per process"""
+    global _exporters_started
+    if _exporters_started:
+        return
+    with _exporters_lock:
+        if _exporters_started:
+            return
+        _exporters_started = True
+        if os.environ.get('DND_METRICS_PORT'):
+            serve_prometheus(int(os.environ['DND_METRICS_PORT']))
+        if os.environ.get('DND_METRICS_JSON'):
+            atexit.register(JsonExporter(os.environ['DND_METRICS_JSON']).stop)
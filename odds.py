@@ -0,0 +1,157 @@
+"""
+Exact fight odds.
+
+Solves a fight as a Markov chain over (player HP, enemy HP, mana) states, using the
+crit, variance and evasion rules from ``combat.py``. The chain factorizes: mana
+follows a fixed path for a given policy, the player's damage rolls never depend on
+player HP and the enemy's hits never depend on enemy HP. So the solver steps the
+enemy-HP and player-HP distributions forward turn by turn as two small arrays and
+combines them, instead of enumerating every joint state. Results are exact up to a
+tail of probability below ``TOLERANCE`` and are memoized in a bounded LRU keyed by
+the stat tuple.
+"""
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
+
+import combat
+
+
+CACHE_SIZE = 4096
+TOLERANCE = 1e-12
+
+Odds = namedtuple('Odds', ['win_probability', 'expected_turns'])
+
+
+def _damage_distribution(base_damage, agility):
+    """
+    Probability of each damage value for one player attack.
+    """
+    crit_p = combat.crit_chance(agility)
+    dist = {}
+    for crit, p_crit in ((True, crit_p), (False, 1 - crit_p)):
+        if p_crit == 0:
+            continue
+        for variance in range(4):
+            damage = combat.attack_damage(base_damage, crit, variance)
+            dist[damage] = dist.get(damage, 0.0) + p_crit / 4
+    return tuple(dist.items())
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _solve(health, mana, strength, agility, skills, enemy_health, enemy_strength, enemy_agility, policy):
+    """
+    Win probability and expected turns from the player's turn in the given state.
+
+    ``skills`` is a tuple of (name, cost, damage_mult) so the arguments stay hashable.
+    """
+    if health <= 0:
+        return Odds(0.0, 0.0)
+    if enemy_health <= 0:
+        return Odds(1.0, 0.0)
+
+    skill_book = {name: {'cost': cost, 'damage_mult': mult} for name, cost, mult in skills}
+    hit = combat.enemy_damage(enemy_strength, agility)
+    evade_p = min(1.0, combat.evasion_chance(agility, enemy_agility))
+    land_p = 1 - evade_p
+    # With h landed hits the player has health - h * hit left, so h < max_hits is alive
+    max_hits = -(-health // hit)
+
+    # remaining[s]: P(s damage dealt so far, enemy still standing)
+    # alive[h]: P(h enemy hits landed, player still standing)
+    remaining = np.zeros(enemy_health)
+    remaining[0] = 1.0
+    alive = np.zeros(max_hits)
+    alive[0] = 1.0
+    distributions = {}
+    p_win = 0.0
+    expected = 0.0
+
+    turn = 0
+    while True:
+        turn += 1
+        skill = combat.choose_skill(skill_book, mana, policy)
+        if skill:
+            base_damage = int(strength * skill_book[skill]['damage_mult'])
+            mana -= skill_book[skill]['cost']
+        else:
+            base_damage = strength
+        if base_damage not in distributions:
+            distributions[base_damage] = _damage_distribution(base_damage, agility)
+
+        # Player attacks
+        dealt = np.zeros(enemy_health)
+        killed = 0.0
+        for damage, p in distributions[base_damage]:
+            if damage < enemy_health:
+                dealt[damage:] += p * remaining[:-damage]
+                killed += p * remaining[enemy_health - damage:].sum()
+            else:
+                killed += p * remaining.sum()
+        remaining = dealt
+        player_up = alive.sum()
+        p_win += killed * player_up
+        expected += turn * killed * player_up
+
+        # Enemy counter-attacks if it is still standing
+        landed = alive * land_p
+        alive = alive * evade_p
+        alive[1:] += landed[:-1]
+        enemy_up = remaining.sum()
+        expected += turn * enemy_up * landed[-1]
+
+        if enemy_up * alive.sum() < TOLERANCE:
+            break
+
+    return Odds(float(p_win), float(expected))
+
+
+def fight_odds(player, enemy, enemy_health=None, policy="basic"):
+    """
+    Exact probability of winning a fight and its expected length in player turns.
+
+    Args:
+        player (dict): Stat block with health, mana, strength, agility and optional skills
+        enemy (dict): Enemy or boss record
+        enemy_health (int): Enemy's current HP, defaults to its full health
+        policy (str): "basic" or "skills", see ``combat.choose_skill``
+
+    Returns:
+        Odds: (win_probability, expected_turns)
+    """
+    skills = tuple((name, info['cost'], info['damage_mult']) for name, info in player.get('skills', {}).items())
+    return _solve(
+        player['health'], player['mana'], player['strength'], player['agility'], skills,
+        enemy['health'] if enemy_health is None else enemy_health,
+        enemy['strength'], enemy.get('agility', 5), policy,
+    )
+
+
+def state_odds(state, classes, policy="basic"):
+    """
+    Odds for the fight currently in progress in ``state``. Status effects, on
+    either side, are not part of the model.
+    """
+    player = {
+        'health': state.health,
+        'mana': state.mana,
+        'strength': state.strength,
+        'agility': state.agility,
+        'skills': classes[state.player_class]['skills'],
+    }
+    return fight_odds(player, state.enemy, state.enemy_health, policy)
+
+
+def cache_info():
+    """
+    Hit/miss statistics of the odds cache.
+    """
+    return _solve.cache_info()
+
+
+def clear_cache():
+    """
+    Drop every memoized result, e.g. after the content data changes.
+    """
+    _solve.cache_clear()
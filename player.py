@@ -0,0 +1,277 @@
+"""
+Compact player state.
+
+``PlayerState`` holds one game session: the object the actions in ``actions.py``
+work on, kept in ``st.session_state.game`` by the Streamlit app. With thousands
+of sessions in one process, its size sets how many players a process can hold,
+so it keeps no copies of content:
+
+    enemy               the index of the record in ``content.roster`` when it is an
+                        authored enemy, boss or horde (a loaded save's enemy dict
+                        is matched back to it); other enemies, such as a horde's
+                        summary or a generated floor's, are kept as given
+    player_image        only stored when it differs from the class's image
+    defeated_enemies    a ``Flags`` bitset over roster indexes
+    solved_puzzles      a ``Flags`` bitset over floor numbers
+    message_log         a ``MessageLog`` ring buffer of the newest LOG_LINES lines;
+                        older lines are in the database (see ``database.py``),
+                        and lines no save has taken yet are kept until one does
+
+Every other field is a plain slot. Fields can also be read and written by key
+and set with ``update``, as on ``st.session_state``.
+"""
+import os
+from collections import deque
+from collections.abc import MutableSet
+
+
+LOG_LINES = int(os.environ.get('DND_LOG_LINES', '50'))
+
+FIELDS = (
+    'player_class', 'player_image', 'health', 'mana', 'strength', 'agility', 'max_health', 'max_mana',
+    'floor', 'in_combat', 'enemy', 'enemy_group', 'enemy_health', 'in_puzzle', 'puzzle_solved',
+    'message_log', 'message_log_base', 'game_over', 'skill_points', 'pending_skill_points',
+    'fighting_boss', 'solved_puzzles', 'enemies_defeated', 'defeated_enemies', 'encountered_by_floor',
+    'pending_events', 'combat_events', 'effects', 'endless', 'tower_seed', 'event_seq', 'snapshot_seq',
+)
+
+
+class Flags(MutableSet):
+    """
+    A set kept as the bits of one int. ``ids`` maps members to bit numbers and
+    ``members`` maps them back; without them the members are the bit numbers.
+    Members ``ids`` does not know are kept in an ordinary set.
+    """
+    __slots__ = ('bits', 'ids', 'members', 'extra')
+
+    def __init__(self, members=(), ids=None, names=None):
+        self.bits = 0
+        self.ids = ids
+        self.members = names
+        self.extra = None
+        for member in members:
+            self.add(member)
+
+    def _bit(self, member):
+        if self.ids is not None:
+            return self.ids.get(member)
+        return member if isinstance(member, int) and member >= 0 else None
+
+    def __contains__(self, member):
+        bit = self._bit(member)
+        if bit is None:
+            return self.extra is not None and member in self.extra
+        return self.bits >> bit & 1 == 1
+
+    def add(self, member):
+        bit = self._bit(member)
+        if bit is not None:
+            self.bits |= 1 << bit
+        elif self.extra is None:
+            self.extra = {member}
+        else:
+            self.extra.add(member)
+
+    def discard(self, member):
+        bit = self._bit(member)
+        if bit is not None:
+            self.bits &= ~(1 << bit)
+        elif self.extra is not None:
+            self.extra.discard(member)
+
+    def __iter__(self):
+        bits = self.bits
+        while bits:
+            low = bits & -bits
+            bit = low.bit_length() - 1
+            yield bit if self.members is None else self.members[bit]['name']
+            bits ^= low
+        if self.extra:
+            yield from list(self.extra)
+
+    def __len__(self):
+        return self.bits.bit_count() + (len(self.extra) if self.extra else 0)
+
+    def __repr__(self):
+        return f"Flags({list(self)!r})"
+
+
+class MessageLog:
+    """
+    The newest ``capacity`` lines of a game log. ``base`` is the number of the
+    oldest line kept, counted from the start of the game.
+
+    Once a save takes lines from the log (``take`` or ``mark``), lines it has not
+    taken yet are never lost: one action can write more lines than the buffer
+    holds, so those that scroll out before the next ``take`` are held in ``spill``
+    until then. A log no save takes from is a plain ring buffer.
+    """
+    __slots__ = ('lines', 'base', 'marked', 'spill')
+
+    def __init__(self, lines=(), base=0, capacity=LOG_LINES):
+        lines = list(lines)
+        self.lines = deque(lines, maxlen=capacity)
+        self.base = base + len(lines) - len(self.lines)
+        self.marked = None
+        self.spill = None
+
+    @property
+    def end(self):
+        """Number of lines written since the start of the game"""
+        return self.base + len(self.lines)
+
+    def append(self, line):
+        if len(self.lines) == self.lines.maxlen:
+            if self.marked is not None and self.base >= self.marked:
+                if self.spill is None:
+                    self.spill = []
+                self.spill.append(self.lines[0])
+            self.base += 1
+        self.lines.append(line)
+
+    def clear(self):
+        self.base = self.end
+        self.lines.clear()
+        self.spill = None
+
+    def take(self):
+        """
+        Hand every line so far to a save.
+
+        Returns:
+            tuple: (the lines held, including those kept for the save, oldest first,
+                    number of the first)
+        """
+        spill = self.spill or ()
+        lines = tuple(spill) + tuple(self.lines)
+        first = self.base - len(spill)
+        self.spill = None
+        self.marked = self.end
+        return lines, first
+
+    def filling(self):
+        """True once the lines since ``take`` fill most of the buffer, so a save can take them between actions"""
+        return self.marked is not None and self.end - self.marked >= self.lines.maxlen * 3 // 4
+
+    def mark(self):
+        """Note that a save already has every line so far, e.g. after loading it"""
+        self.spill = None
+        self.marked = self.end
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __iter__(self):
+        return iter(self.lines)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self.lines)[index]
+        return self.lines[index]
+
+    def __eq__(self, other):
+        return isinstance(other, (MessageLog, list)) and list(self) == list(other)
+
+    def __repr__(self):
+        return f"MessageLog({list(self.lines)!r}, base={self.base})"
+
+
+class PlayerState:
+    """One session's game state, referring to ``content`` rather than copying it"""
+    __slots__ = ('content', '_enemy', '_player_image', '_message_log', '_defeated', '_solved') + tuple(
+        field for field in FIELDS if field not in ('enemy', 'player_image', 'message_log', 'message_log_base',
+                                                   'defeated_enemies', 'solved_puzzles'))
+
+    def __init__(self, content=None, **fields):
+        self.content = content
+        for field in FIELDS:
+            setattr(self, field, None)
+        self.update(fields)
+
+    @property
+    def enemy(self):
+        ref = self._enemy
+        return self.content.roster[ref] if type(ref) is int else ref
+
+    @enemy.setter
+    def enemy(self, record):
+        self._enemy = record
+        if record is not None and self.content is not None:
+            found = self.content.roster_ids.get(record.get('name'))
+            if found is not None and (self.content.roster[found] is record or self.content.roster[found] == record):
+                self._enemy = found
+
+    @property
+    def player_image(self):
+        if self._player_image is None and self.content is not None and self.player_class in self.content.classes:
+            return self.content.classes[self.player_class]['image_url']
+        return self._player_image
+
+    @player_image.setter
+    def player_image(self, image):
+        shared = self.content is not None and self.content.classes.get(self.player_class)
+        self._player_image = None if shared and shared['image_url'] == image else image
+
+    @property
+    def message_log(self):
+        return self._message_log
+
+    @message_log.setter
+    def message_log(self, lines):
+        self._message_log = lines if isinstance(lines, MessageLog) or lines is None else MessageLog(lines)
+
+    @property
+    def message_log_base(self):
+        return self._message_log.base if self._message_log is not None else 0
+
+    @message_log_base.setter
+    def message_log_base(self, base):
+        log = self._message_log
+        if log is not None and base is not None:
+            if log.marked is not None:
+                log.marked += base - log.base
+            log.base = base
+
+    @property
+    def defeated_enemies(self):
+        return self._defeated
+
+    @defeated_enemies.setter
+    def defeated_enemies(self, names):
+        content = self.content
+        self._defeated = None if names is None else Flags(
+            names, content.roster_ids if content else {}, content.roster if content else None)
+
+    @property
+    def solved_puzzles(self):
+        return self._solved
+
+    @solved_puzzles.setter
+    def solved_puzzles(self, floors):
+        self._solved = None if floors is None else Flags(floors)
+
+    def update(self, fields=(), **more):
+        # player_class first, so player_image is compared against the right class
+        fields = dict(fields, **more)
+        if 'player_class' in fields:
+            self.player_class = fields.pop('player_class')
+        # The log in one step, so lines the buffer cannot hold move up the base of those it keeps
+        if fields.get('message_log') is not None and not isinstance(fields['message_log'], MessageLog):
+            self._message_log = MessageLog(fields.pop('message_log'), fields.pop('message_log_base', None) or 0)
+        for field, value in fields.items():
+            setattr(self, field, value)
+
+    def __getitem__(self, field):
+        try:
+            return getattr(self, field)
+        except AttributeError:
+            raise KeyError(field) from None
+
+    def __setitem__(self, field, value):
+        setattr(self, field, value)
+
+    def __contains__(self, field):
+        return field in FIELDS
+
+    def get(self, field, default=None):
+        return getattr(self, field, default)
@@ -0,0 +1,262 @@
+"""
+Sharded save storage.
+
+Saves are spread over N SQLite files by a stable hash of their name, so each file
+has its own writer and stays small. ``ShardedDatabase`` offers the same methods as
+``GameDatabase``: calls about one save go to that save's shard, listings and
+statistics query every shard in parallel and merge the results.
+
+A layout of N shards next to ``dnd_game.db`` uses ``dnd_game.0-of-N.db`` ...
+``dnd_game.<N-1>-of-N.db``; one shard is the plain ``dnd_game.db``. Because the
+file names include N, changing the shard count copies every save into a fresh
+layout, which the rebalancing tool does offline (with the game stopped).
+
+Usage:
+    python shards.py --from 1 --to 4 [--db dnd_game.db] [--keep]
+"""
+import argparse
+import heapq
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from database import (DB_FILE, LOG_PAGE_SIZE, SAVE_PAGE_SIZE, SELECT_SAVE_ID, CacheInfo, GameDatabase)
+
+
+# Tables that hang off game_saves.id, copied along with their save
+CHILD_TABLES = ('message_log', 'game_events', 'combat_logs', 'achievements')
+
+# Above any real row id, for cursors that must include a whole updated_at second
+MAX_ID = 2 ** 63 - 1
+
+
+def shard_index(save_name, count):
+    """Shard a save name belongs to; crc32 so it is the same in every process"""
+    return zlib.crc32(save_name.encode('utf-8')) % count
+
+
+def shard_paths(db_name, count):
+    """Database files of a layout with ``count`` shards"""
+    if count == 1:
+        return [db_name]
+    root, ext = os.path.splitext(db_name)
+    return [f"{root}.{i}-of-{count}{ext}" for i in range(count)]
+
+
+class ShardedDatabase:
+    """GameDatabase over several files, routing each save by the hash of its name"""
+
+    def __init__(self, db_name=DB_FILE, count=2, single_writer=False):
+        self.db_name = db_name
+        self.shards = [GameDatabase(path, single_writer) for path in shard_paths(db_name, count)]
+        self._executor = ThreadPoolExecutor(max_workers=count, thread_name_prefix="shard")
+
+    def shard(self, save_name):
+        """The GameDatabase holding a save"""
+        return self.shards[shard_index(save_name, len(self.shards))]
+
+    def _each(self, read):
+        """Run ``read(index, shard)`` on every shard in parallel and return the results in shard order"""
+        return list(self._executor.map(read, range(len(self.shards)), self.shards))
+
+    # One save: straight to its shard
+
+    def save_game(self, save_name, session_state):
+        return self.shard(save_name).save_game(save_name, session_state)
+
+    def queue_save(self, save_name, session_state):
+        self.shard(save_name).queue_save(save_name, session_state)
+
+    def record_action(self, save_name, session_state, action, args, seed, snapshot=False):
+        self.shard(save_name).record_action(save_name, session_state, action, args, seed, snapshot)
+
+    def get_events(self, save_name, after=0):
+        return self.shard(save_name).get_events(save_name, after)
+
+    def load_game(self, save_name):
+        return self.shard(save_name).load_game(save_name)
+
+    def get_message_log(self, save_name, before, limit=LOG_PAGE_SIZE):
+        return self.shard(save_name).get_message_log(save_name, before, limit)
+
+    def delete_game(self, save_name):
+        return self.shard(save_name).delete_game(save_name)
+
+    def get_achievements(self, save_name):
+        return self.shard(save_name).get_achievements(save_name)
+
+    def get_combat_history(self, save_name, limit=10):
+        return self.shard(save_name).get_combat_history(save_name, limit)
+
+    # Every save: query all shards and merge
+
+    def list_saves(self):
+        """List all saved games, most recently played first"""
+        lists = self._each(lambda i, shard: shard.list_saves())
+        return list(heapq.merge(*lists, key=lambda row: row[4], reverse=True))
+
+    def browse_saves(self, limit=SAVE_PAGE_SIZE, after=None, **filters):
+        """
+        Get one page of saves across all shards, see ``GameDatabase.browse_saves``.
+
+        Saves are ordered by (updated_at, shard, id), so the cursor is that triple
+        for the last save on the page.
+        """
+        def page(i, shard):
+            shard_after = None
+            if after:
+                updated_at, last_shard, last_id = after
+                # Shards before the cursor's still have saves from its second, later ones do not
+                if i < last_shard:
+                    shard_after = (updated_at, MAX_ID)
+                elif i == last_shard:
+                    shard_after = (updated_at, last_id)
+                else:
+                    shard_after = (updated_at, 0)
+            return [(row[4], i, row[5], row[:5]) for row in shard.browse_page(limit + 1, shard_after, **filters)]
+
+        merged = heapq.merge(*self._each(page), reverse=True)
+        rows = [next(merged, None) for _ in range(limit + 1)]
+        rows = [row for row in rows if row is not None]
+        cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            cursor = rows[-1][:3]
+        return [row[3] for row in rows], cursor
+
+    def damage_taken_by_enemy(self):
+        """Get (enemy, fights, total damage taken, average per fight) across all shards"""
+        totals = {}
+        for rows in self._each(lambda i, shard: shard.damage_taken_by_enemy()):
+            for enemy, fights, damage, _ in rows:
+                total = totals.setdefault(enemy, [0, 0])
+                total[0] += fights
+                total[1] += damage
+        rows = [(enemy, fights, damage, damage / fights) for enemy, (fights, damage) in totals.items()]
+        return sorted(rows, key=lambda row: -row[3])
+
+    def turns_by_enemy(self):
+        """Get (enemy, fights, average player turns per fight) across all shards"""
+        totals = {}
+        for rows in self._each(lambda i, shard: shard.turns_by_enemy()):
+            for enemy, fights, turns in rows:
+                total = totals.setdefault(enemy, [0, 0])
+                total[0] += fights
+                total[1] += turns * fights
+        rows = [(enemy, fights, turns / fights) for enemy, (fights, turns) in totals.items()]
+        return sorted(rows, key=lambda row: -row[2])
+
+    def kill_rate_by_class(self):
+        """Get (class, fights, fights won, win rate) across all shards"""
+        totals = {}
+        for rows in self._each(lambda i, shard: shard.kill_rate_by_class()):
+            for player_class, fights, wins, _ in rows:
+                total = totals.setdefault(player_class, [0, 0])
+                total[0] += fights
+                total[1] += wins
+        return [(player_class, fights, wins, wins / fights)
+                for player_class, (fights, wins) in sorted(totals.items())]
+
+    def log_gaps(self):
+        """Get the names of saves whose stored message log is missing lines, across all shards"""
+        return sorted(name for names in self._each(lambda i, shard: shard.log_gaps()) for name in names)
+
+    def flush(self):
+        """Write every queued save on every shard"""
+        saved = {}
+        for save_ids in self._each(lambda i, shard: shard.flush()):
+            saved.update(save_ids)
+        return saved
+
+    def cache_info(self):
+        """Read cache statistics summed over the shards"""
+        infos = [shard.cache_info() for shard in self.shards]
+        return CacheInfo(*(sum(values) for values in zip(*infos)))
+
+    def close(self):
+        """Write pending saves on every shard and stop their writers"""
+        self._each(lambda i, shard: shard.close())
+        self._executor.shutdown()
+
+
+def copy_save(source, target, save_name):
+    """
+    Copy one save and all of its rows from one shard connection to another.
+
+    Returns:
+        bool: False if the target already had the save (a resumed rebalance)
+    """
+    if target.execute(SELECT_SAVE_ID, (save_name,)).fetchone():
+        return False
+    with target:
+        cursor = source.execute("SELECT * FROM game_saves WHERE save_name = ?", (save_name,))
+        row = dict(zip([d[0] for d in cursor.description], cursor.fetchone()))
+        old_id = row.pop('id')
+        new_id = target.execute(
+            f"INSERT INTO game_saves ({', '.join(row)}) VALUES ({', '.join('?' * len(row))})",
+            list(row.values())).lastrowid
+
+        for table in CHILD_TABLES:
+            cursor = source.execute(f"SELECT * FROM {table} WHERE save_id = ?", (old_id,))
+            columns = [d[0] for d in cursor.description]
+            keep = [i for i, column in enumerate(columns) if column != 'id']
+            save_col = columns.index('save_id')
+            rows = [[new_id if i == save_col else values[i] for i in keep] for values in cursor]
+            if rows:
+                names = [columns[i] for i in keep]
+                target.executemany(
+                    f"INSERT INTO {table} ({', '.join(names)}) VALUES ({', '.join('?' * len(names))})", rows)
+    return True
+
+
+def rebalance(db_name, old_count, new_count, keep=False):
+    """
+    Move every save from a layout of ``old_count`` shards to one of ``new_count``.
+
+    Run it with the game stopped. Each save is copied in its own transaction and
+    saves already in the new layout are skipped, so an interrupted run can simply
+    be started again. The old files are removed at the end unless ``keep`` is set.
+
+    Returns:
+        int: Number of saves copied
+    """
+    if old_count == new_count:
+        return 0
+    targets = [GameDatabase(path) for path in shard_paths(db_name, new_count)]
+    copied = 0
+    sources = [path for path in shard_paths(db_name, old_count) if os.path.exists(path)]
+    for path in sources:
+        source = GameDatabase(path)
+        conn = source.connection()
+        names = [name for name, in conn.execute("SELECT save_name FROM game_saves ORDER BY id")]
+        for name in names:
+            target = targets[shard_index(name, new_count)].connection()
+            copied += copy_save(conn, target, name)
+        source.close()
+        source.pool.close()
+
+    for target in targets:
+        target.close()
+        target.pool.close()
+    if not keep:
+        for path in sources:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+    return copied
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Move saves to a different number of shards (game stopped).")
+    parser.add_argument('--db', default=DB_FILE, help="base database file name")
+    parser.add_argument('--from', dest='old', type=int, required=True, help="current number of shards")
+    parser.add_argument('--to', dest='new', type=int, required=True, help="new number of shards")
+    parser.add_argument('--keep', action='store_true', help="keep the old shard files")
+    args = parser.parse_args(argv)
+
+    copied = rebalance(args.db, args.old, args.new, args.keep)
+    print(f"Copied {copied} saves into {', '.join(shard_paths(args.db, args.new))}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+"""
+Batch fight simulator.
+
+Resolves thousands of fights at once as NumPy arrays, using the same damage, crit,
+evasion and status effect rules as ``combat.py``. Each fight is one lane of the
+arrays: the player acts (basic attack or the strongest affordable skill), then
+the effects on both sides tick and the enemy counter-attacks if it survived,
+until one side drops or ``max_turns`` is hit.
+
+Usage:
+    python simulator.py [--fights 10000] [--policy basic|skills] [--seed 0] [--json]
+"""
+import argparse
+import heapq
+import json
+from collections import namedtuple
+
+import numpy as np
+
+import combat
+import effects
+from content import DATA_FILE, get_content
+
+
+MAX_TURNS = 200
+
+FightResults = namedtuple('FightResults', ['won', 'turns', 'player_health', 'enemy_health'])
+
+
+def load_roster(path=DATA_FILE):
+    """
+    Load the classes and every enemy/boss from the game data file.
+
+    Returns:
+        tuple: (classes mapping, list of (kind, floor, enemy record))
+    """
+    content = get_content(path)
+    opponents = []
+    for floor in sorted(content.enemies):
+        for enemy in content.enemies[floor]:
+            opponents.append(('enemy', floor, enemy))
+    for floor in sorted(content.bosses):
+        opponents.append(('boss', floor, content.bosses[floor]))
+    return content.classes, opponents
+
+
+class LaneEffects:
+    """
+    Status effects on one side of many fights, following ``effects.py``.
+
+    Damage stacks inflicted together are one heap entry holding their lanes, so a
+    turn pops only the batches that expire on it.
+    """
+
+    def __init__(self, n_fights):
+        self.damage = np.zeros(n_fights, dtype=np.int64)
+        self.stacks = {}
+        self.until = {}
+        self.heap = []
+        self.seq = 0
+
+    def inflict(self, lanes, status, base_damage, turn):
+        info = effects.EFFECTS[status]
+        expires = turn + 1 + info['duration']
+        if info['kind'] == 'hold':
+            until = self.until.setdefault(status, np.zeros(self.damage.size, dtype=np.int64))
+            until[lanes] = np.maximum(until[lanes], expires)
+            return
+        stacks = self.stacks.setdefault(status, np.zeros(self.damage.size, dtype=np.int64))
+        lanes = lanes[stacks[lanes] < info['max_stacks']]
+        damage = effects.tick_damage(status, base_damage)
+        stacks[lanes] += 1
+        self.damage[lanes] += damage
+        self.seq += 1
+        heapq.heappush(self.heap, (expires, self.seq, status, lanes, damage))
+
+    def expire(self, turn):
+        while self.heap and self.heap[0][0] <= turn:
+            _, _, status, lanes, damage = heapq.heappop(self.heap)
+            self.damage[lanes] -= damage
+            self.stacks[status][lanes] -= 1
+
+    def held(self, lanes, turn):
+        held = np.zeros(lanes.size, dtype=bool)
+        for until in self.until.values():
+            held |= until[lanes] > turn
+        return held
+
+
+def _roll(lanes, chance, rng):
+    """The lanes where an effect with ``chance`` lands"""
+    return lanes if chance >= 1 else lanes[rng.random(lanes.size) < chance]
+
+
+def simulate_fights(player, enemy, n_fights=10000, policy="basic", rng=None, max_turns=MAX_TURNS):
+    """
+    Simulate ``n_fights`` independent fights between one player and one enemy.
+
+    Args:
+        player (dict): Stat block with health, mana, strength, agility and skills
+        enemy (dict): Enemy or boss record
+        n_fights (int): Number of fights to run side by side
+        policy (str): "basic" or "skills", see ``combat.choose_skill``
+        rng: Seed or ``numpy.random.Generator``
+        max_turns (int): Fights still running after this many turns count as losses
+
+    Returns:
+        FightResults: Per-fight arrays (won, turns taken, player HP left, enemy HP left)
+    """
+    rng = np.random.default_rng(rng)
+    skills = player.get('skills', {})
+    combat.choose_skill(skills, 0, policy)  # validates the policy name
+    # Strongest first, keeping data-file order on ties like choose_skill does
+    ranked = sorted(skills.values(), key=lambda info: -info['damage_mult']) if policy == "skills" else []
+
+    strength = player['strength']
+    agility = player['agility']
+    crit_p = combat.crit_chance(agility)
+    evade_p = combat.evasion_chance(agility, enemy.get('agility', 5))
+    hit = combat.enemy_damage(enemy['strength'], agility)
+    enemy_effect = effects.source(enemy)
+
+    health = np.full(n_fights, player['health'], dtype=np.int64)
+    mana = np.full(n_fights, player['mana'], dtype=np.int64)
+    enemy_health = np.full(n_fights, enemy['health'], dtype=np.int64)
+    turns = np.zeros(n_fights, dtype=np.int64)
+    won = np.zeros(n_fights, dtype=bool)
+    active = np.ones(n_fights, dtype=bool)
+    on_player = LaneEffects(n_fights)
+    on_enemy = LaneEffects(n_fights)
+
+    for turn in range(max_turns):
+        idx = np.flatnonzero(active)
+        if idx.size == 0:
+            break
+
+        # Player: lanes frozen or stunned lose the attack; turn is the last enemy turn
+        acting = idx[~on_player.held(idx, turn + 1)]
+        base = np.full(acting.size, strength, dtype=np.int64)
+        chosen = np.zeros(acting.size, dtype=bool)
+        inflicts = []
+        for info in ranked:
+            use = ~chosen & (mana[acting] >= info['cost'])
+            base[use] = int(strength * info['damage_mult'])
+            mana[acting[use]] -= info['cost']
+            chosen |= use
+            if effects.source(info):
+                inflicts.append((acting[use], int(strength * info['damage_mult']), effects.source(info)))
+
+        crit = rng.random(acting.size) < crit_p
+        damage = np.maximum(1, base + np.where(crit, base // 2, 0) - rng.integers(0, 4, acting.size))
+        enemy_health[acting] -= damage
+        turns[idx] += 1
+        for lanes, skill_damage, (status, chance) in inflicts:
+            lanes = lanes[enemy_health[lanes] > 0]
+            on_enemy.inflict(_roll(lanes, chance, rng), status, skill_damage, turn)
+
+        # Enemy: effects on both sides tick, then it attacks unless held
+        turn += 1
+        survivors = idx[enemy_health[idx] > 0]
+        on_enemy.expire(turn)
+        enemy_health[survivors] -= on_enemy.damage[survivors]
+        killed = idx[enemy_health[idx] <= 0]
+        won[killed] = True
+        active[killed] = False
+        survivors = survivors[enemy_health[survivors] > 0]
+
+        on_player.expire(turn)
+        health[survivors] -= on_player.damage[survivors]
+        attackers = survivors[(health[survivors] > 0) & ~on_enemy.held(survivors, turn)]
+        landed = attackers[rng.random(attackers.size) >= evade_p]
+        health[landed] -= hit
+        if enemy_effect:
+            status, chance = enemy_effect
+            lanes = landed[health[landed] > 0]
+            on_player.inflict(_roll(lanes, chance, rng), status, enemy['strength'], turn)
+        died = survivors[health[survivors] <= 0]
+        health[died] = 0
+        active[died] = False
+
+    return FightResults(won, turns, health, np.maximum(enemy_health, 0))
+
+
+def _distribution(values):
+    """
+    Summary statistics for one array of per-fight values.
+    """
+    if values.size == 0:
+        return None
+    p10, p50, p90 = np.percentile(values, [10, 50, 90])
+    return {
+        'mean': float(values.mean()),
+        'min': int(values.min()),
+        'p10': float(p10),
+        'p50': float(p50),
+        'p90': float(p90),
+        'max': int(values.max()),
+    }
+
+
+def summarize(results):
+    """
+    Reduce simulated fights to win rate, turns-to-kill and HP-remaining distributions.
+
+    Turns-to-kill and HP remaining are taken over won fights only.
+    """
+    wins = results.won
+    return {
+        'fights': int(wins.size),
+        'win_rate': float(wins.mean()) if wins.size else 0.0,
+        'turns_to_kill': _distribution(results.turns[wins]),
+        'hp_remaining': _distribution(results.player_health[wins]),
+    }
+
+
+def simulate_roster(n_fights=10000, policy="basic", seed=None, path=DATA_FILE):
+    """
+    Simulate every class against every enemy and boss in the data file.
+
+    Returns:
+        list: One summary dict per (class, opponent) pair
+    """
+    classes, opponents = load_roster(path)
+    streams = np.random.SeedSequence(seed).spawn(len(classes) * len(opponents))
+    report = []
+    for class_name, player in classes.items():
+        for kind, floor, enemy in opponents:
+            results = simulate_fights(player, enemy, n_fights, policy, np.random.default_rng(streams.pop()))
+            row = {'class': class_name, 'kind': kind, 'floor': floor, 'enemy': enemy['name']}
+            row.update(summarize(results))
+            report.append(row)
+    return report
+
+
+def format_report(report):
+    """
+    Render a roster report as a plain-text table.
+    """
+    lines = [f"{'Class':<8} {'Floor':>5} {'Opponent':<20} {'Win %':>6} {'Turns p50':>9} {'HP left p50':>11}"]
+    for row in report:
+        turns = row['turns_to_kill']['p50'] if row['turns_to_kill'] else float('nan')
+        hp_left = row['hp_remaining']['p50'] if row['hp_remaining'] else float('nan')
+        name = row['enemy'] + (' (boss)' if row['kind'] == 'boss' else '')
+        lines.append(f"{row['class']:<8} {row['floor']:>5} {name:<20} {row['win_rate'] * 100:>6.1f} "
+                     f"{turns:>9.1f} {hp_left:>11.1f}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate every class against every enemy and boss.")
+    parser.add_argument('--fights', type=int, default=10000, help="fights per matchup")
+    parser.add_argument('--policy', choices=['basic', 'skills'], default='basic')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--data', default=DATA_FILE)
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    args = parser.parse_args(argv)
+
+    report = simulate_roster(args.fights, args.policy, args.seed, args.data)
+    print(json.dumps(report, indent=2) if args.json else format_report(report))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+"""
+Procedural floors.
+
+The authored floors come from the game data. Past the last of them the tower is
+generated: each floor's enemies, boss, horde, puzzle and story are rolled from the
+run's ``tower_seed`` and the floor number, with stats grown by GROWTH per floor
+from the last authored floors. A floor is only generated when the game first asks
+for it and the most recently used FLOOR_CACHE floors are kept, so memory and
+startup cost stay the same however high a player climbs.
+
+``for_state`` gives an action the content of its run: the same ``Content`` record
+with its floor-keyed sections replaced by views that fall through to generated
+floors, so the rest of the game looks a floor up the same way whether it was
+written or generated. Iterating a view covers the authored floors only.
+
+The top of the tower is ``GAME_CONFIG.MAX_FLOOR``; an endless run has none.
+
+Usage:
+    python tower.py [--seed 0] [--first 11] [--floors 5]
+"""
+import argparse
+import itertools
+import math
+import os
+import random
+import statistics
+import threading
+from collections import OrderedDict, namedtuple
+from collections.abc import Mapping
+
+from content import DATA_FILE, _freeze, get_content
+
+
+FLOOR_CACHE = int(os.environ.get('DND_FLOOR_CACHE', '64'))
+DEFAULT_TOP = 10          # top floor when GAME_CONFIG has no MAX_FLOOR
+GROWTH = 1.08             # enemy stat growth per generated floor
+BASE_FLOORS = 3           # authored floors whose median stats generated floors grow from
+ENEMIES_PER_FLOOR = 3     # beating them all brings out the floor's boss
+HORDE_EVERY = 3           # generated floors between hordes
+MAX_HORDE = 1000          # members in a generated horde
+
+TITLES = ("Cursed", "Ancient", "Frenzied", "Hollow", "Ashen", "Starving", "Gilded", "Rotting",
+          "Storm-touched", "Blind", "Veiled", "Iron")
+BOSS_TITLES = ("Undying", "Eternal", "Ravenous", "Forsaken", "Sovereign", "Dread")
+PLACES = ("Shattered Gallery", "Hall of Echoes", "Sunken Vault", "Bone Orchard", "Clockwork Spire",
+          "Starless Observatory", "Weeping Library", "Ashen Cloister", "Hanging Gardens", "Mirror Maze")
+SIGHTS = ("Cold winds howl through broken stone.", "Something old stirs behind the walls.",
+          "The stairs shift when you look away.", "Candles burn without melting.",
+          "Claw marks cover every door.", "The air hums with stolen magic.")
+
+Floor = namedtuple('Floor', ['enemies', 'enemy_names', 'boss', 'horde', 'puzzle', 'story'])
+
+# Content section -> Floor field
+SECTIONS = {
+    'enemies': 'enemies',
+    'enemy_names': 'enemy_names',
+    'bosses': 'boss',
+    'hordes': 'horde',
+    'puzzles': 'puzzle',
+    'floor_story': 'story',
+}
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+
+def last_authored(content):
+    """The highest floor the game data has enemies for"""
+    return max(content.enemies, default=0)
+
+
+def max_floor(content):
+    """The top floor of a normal run"""
+    return content.config.get('MAX_FLOOR', DEFAULT_TOP)
+
+
+def top(state, content):
+    """The top floor of this run, infinite in endless mode"""
+    return math.inf if getattr(state, 'endless', False) else max_floor(content)
+
+
+def _median_stats(records):
+    return {stat: statistics.median(record.get(stat, 5) for record in records)
+            for stat in ('health', 'strength', 'agility')}
+
+
+def _grown(template, stats, factor, rng, **fields):
+    """A copy of ``template`` with ``stats`` grown by ``factor``, give or take 15%"""
+    record = {key: value for key, value in template.items() if key not in ('description', 'count')}
+    for stat, value in stats.items():
+        record[stat] = max(1, round(value * factor * rng.uniform(0.85, 1.15)))
+    record.update(fields)
+    return record
+
+
+def _puzzle(content, rng):
+    kind = rng.randrange(3)
+    if kind == 0 and content.puzzles:
+        return rng.choice(list(content.puzzles.values()))
+    if kind == 1:
+        start, step = rng.randint(1, 20), rng.randint(2, 9)
+        terms = ', '.join(str(start + step * i) for i in range(4))
+        return {'question': f"What number comes next: {terms}, ...?", 'answer': str(start + step * 4)}
+    number, added = rng.randint(3, 50), rng.randint(1, 30)
+    return {'question': f"Double me and add {added} and you get {number * 2 + added}. What number am I?",
+            'answer': str(number)}
+
+
+def generate_floor(content, seed, number):
+    """
+    Roll one floor past the authored ones. The same content, seed and floor always
+    give the same floor.
+    """
+    rng = random.Random(f"{seed}:{number}")
+    last = last_authored(content)
+    depth = number - last
+    factor = GROWTH ** depth
+    recent = range(last - BASE_FLOORS + 1, last + 1)
+
+    enemy_stats = _median_stats([e for floor in recent for e in content.enemies.get(floor, ())])
+    templates = rng.sample([e for floor in sorted(content.enemies) for e in content.enemies[floor]],
+                           min(ENEMIES_PER_FLOOR, sum(len(e) for e in content.enemies.values())))
+    # Names are unique across floors, since beaten enemies are remembered by name
+    enemies = tuple(_freeze(_grown(template, enemy_stats, factor, rng,
+                                   name=f"{title} {template['name']} of Floor {number}"))
+                    for template, title in zip(templates, rng.sample(TITLES, len(templates))))
+
+    boss = None
+    if content.bosses:
+        template = rng.choice(list(content.bosses.values()))
+        boss_stats = _median_stats([content.bosses[floor] for floor in recent if floor in content.bosses])
+        boss = _freeze(_grown(template, boss_stats, factor, rng, description=template.get('description', ''),
+                              name=f"{rng.choice(BOSS_TITLES)} {template['name']}"))
+
+    horde = None
+    if content.hordes and depth % HORDE_EVERY == 0:
+        floor = rng.choice(sorted(content.hordes))
+        template = content.hordes[floor]
+        count_factor = 1 + depth // HORDE_EVERY
+        members = tuple(_freeze(_grown(member, {s: member.get(s, 5) for s in ('health', 'strength', 'agility')},
+                                       GROWTH ** (number - floor), rng,
+                                       count=min(MAX_HORDE, member.get('count', 1) * count_factor)))
+                        for member in template['members'])
+        horde = _freeze(dict(template, name=f"{template['name']} of Floor {number}", members=members))
+
+    story = f"Floor {number}: {rng.choice(PLACES)} - {rng.choice(SIGHTS)}"
+    return Floor(enemies, frozenset(e['name'] for e in enemies), boss, horde, _freeze(_puzzle(content, rng)), story)
+
+
+def get_floor(content, seed, number):
+    """
+    ``generate_floor`` through the LRU cache of recently played floors.
+    """
+    if content.digest is None:
+        # Content compiled from a dict has no identity to cache under
+        return generate_floor(content, seed, number)
+    key = (content.digest, seed, number)
+    with _lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    floor = generate_floor(content, seed, number)
+    with _lock:
+        _cache[key] = floor
+        while len(_cache) > FLOOR_CACHE:
+            _cache.popitem(last=False)
+    return floor
+
+
+def floors(content, seed, first=None):
+    """
+    Yield (number, Floor) for every generated floor from ``first`` up, without end.
+    """
+    for number in itertools.count(max(first or 0, last_authored(content) + 1)):
+        yield number, get_floor(content, seed, number)
+
+
+class FloorView(Mapping):
+    """One floor-keyed section of the content, continued by generated floors"""
+
+    def __init__(self, content, seed, section):
+        self.content = content
+        self.seed = seed
+        self.section = section
+        self.authored = getattr(content, section)
+        self.last = last_authored(content)
+
+    def __getitem__(self, number):
+        if number <= self.last:
+            return self.authored[number]
+        value = getattr(get_floor(self.content, self.seed, number), SECTIONS[self.section])
+        if value is None:
+            raise KeyError(number)
+        return value
+
+    def __iter__(self):
+        return iter(self.authored)
+
+    def __len__(self):
+        return len(self.authored)
+
+
+def for_state(state, content):
+    """
+    The content a run plays on: the authored floors, then floors generated from its seed.
+    """
+    if isinstance(content.enemies, FloorView):
+        content = content.enemies.content
+    seed = getattr(state, 'tower_seed', None) or 0
+    return content._replace(**{section: FloorView(content, seed, section) for section in SECTIONS})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Print generated floors of the tower.")
+    parser.add_argument('--data', default=DATA_FILE)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--first', type=int, default=None, help="first floor (default: the first generated one)")
+    parser.add_argument('--floors', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    content = get_content(args.data)
+    for number, floor in itertools.islice(floors(content, args.seed, args.first), args.floors):
+        print(floor.story)
+        for enemy in floor.enemies:
+            print(f"  {enemy['name']}: {enemy['health']} HP, {enemy['strength']} STR, {enemy['agility']} AGI")
+        if floor.horde:
+            size = sum(member['count'] for member in floor.horde['members'])
+            print(f"  Horde: {floor.horde['name']} ({size} members)")
+        if floor.boss:
+            print(f"  Boss: {floor.boss['name']}: {floor.boss['health']} HP, {floor.boss['strength']} STR")
+        print(f"  Puzzle: {floor.puzzle['question']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,295 @@
+"""
+Balance tuner.
+
+Searches each class's health, strength, agility and skill ``damage_mult``/``cost``
+for values whose simulated fights land inside target bands of win rate and
+turns-to-kill, floor by floor, against the floor's enemies and its boss. Fights
+are resolved by ``simulator.simulate_fights`` (the rules in ``combat.py``).
+
+A player on floor N is modelled as the class's starting stats plus the skill
+points of the floors below, ``--points-per-floor`` each, spread evenly over
+health, mana, strength and agility, entering the fight at full health.
+
+The search is an evolution strategy: every generation perturbs each class's best
+values ``--population`` times and keeps any candidate that misses the bands by
+less. Candidates are simulated on a process pool, all with the same random
+streams so they are compared on the same dice rolls.
+
+Targets are a JSON file of bands, with optional per-floor overrides:
+
+    {"enemy": {"win_rate": [0.9, 1.0], "turns": [2, 5]},
+     "boss": {"win_rate": [0.6, 0.85], "turns": [4, 10]},
+     "floors": {"10": {"boss": {"win_rate": [0.4, 0.6]}}}}
+
+The tuned data is written to ``--out`` (the game data file is left alone) along
+with a report comparing the current and proposed values on fresh random streams.
+
+Usage:
+    python tuner.py [--targets targets.json] [--generations 30] [--population 16]
+                    [--fights 2000] [--policy skills] [--workers N] [--seed 0]
+                    [--out dnd_game_data.proposed.json] [--json]
+"""
+import argparse
+import copy
+import json
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import simulator
+from content import DATA_FILE
+
+
+PROPOSED_FILE = 'dnd_game_data.proposed.json'
+
+DEFAULT_TARGETS = {
+    'enemy': {'win_rate': [0.9, 1.0], 'turns': [2, 5]},
+    'boss': {'win_rate': [0.6, 0.85], 'turns': [4, 10]},
+}
+
+# How far a value may move from the current data, as factors of it
+BOUNDS = {
+    'health': (0.5, 2.0),
+    'strength': (0.5, 2.0),
+    'agility': (0.5, 2.0),
+    'damage_mult': (0.75, 1.5),
+    'cost': (0.5, 2.0),
+}
+STEP = 0.15            # spread of a perturbation, as a log-factor
+STEP_DECAY = 0.95      # per generation
+WIN_RATE_WEIGHT = 4    # missing the win rate band counts this much more than turns
+
+
+def tunable(player):
+    """
+    The values the tuner may change for one class.
+
+    Returns:
+        dict: Flat {key: value}, skills as "skills.<name>.<field>"
+    """
+    params = {stat: player[stat] for stat in ('health', 'strength', 'agility')}
+    for name, info in player.get('skills', {}).items():
+        params[f'skills.{name}.damage_mult'] = info['damage_mult']
+        params[f'skills.{name}.cost'] = info['cost']
+    return params
+
+
+def with_params(player, params):
+    """
+    Copy of a class record with ``params`` (as from ``tunable``) applied.
+    """
+    player = copy.deepcopy(player)
+    for key, value in params.items():
+        if key.startswith('skills.'):
+            _, name, field = key.split('.', 2)
+            player['skills'][name][field] = value
+        else:
+            player[key] = value
+    return player
+
+
+def _field(key):
+    return key.rsplit('.', 1)[-1]
+
+
+def mutate(params, original, step, rng):
+    """
+    Perturb about half of the values by a random factor, kept within BOUNDS of ``original``.
+    """
+    candidate = dict(params)
+    for key, value in params.items():
+        if rng.random() < 0.5:
+            continue
+        low, high = BOUNDS[_field(key)]
+        value = value * math.exp(rng.normal(0, step))
+        value = min(max(value, original[key] * low), original[key] * high)
+        if _field(key) == 'damage_mult':
+            candidate[key] = round(value * 20) / 20
+        else:
+            candidate[key] = max(1, round(value))
+    return candidate
+
+
+def grown(player, floor, points_per_floor):
+    """
+    A class record with the skill points of the floors below ``floor`` spent evenly.
+    """
+    points = (floor - 1) * points_per_floor
+    share, extra = divmod(points, 4)
+    player = dict(player)
+    player['health'] += share * 10
+    player['mana'] += share * 10
+    player['strength'] += share + extra
+    player['agility'] += share
+    return player
+
+
+def band(targets, kind, floor, metric):
+    """
+    The (low, high) target for one metric of one matchup.
+    """
+    override = targets.get('floors', {}).get(str(floor), {}).get(kind, {})
+    return tuple(override.get(metric, targets[kind][metric]))
+
+
+def band_miss(value, bounds):
+    """
+    How far ``value`` lies outside ``bounds``, in band widths (0 inside).
+    """
+    low, high = bounds
+    return max(0.0, low - value, value - high) / max(high - low, 1e-9)
+
+
+def evaluate(player, opponents, targets, n_fights, policy, points_per_floor, seed):
+    """
+    Simulate one class record against every opponent and score it against the targets.
+
+    Returns:
+        tuple: (loss, one result dict per opponent)
+    """
+    streams = np.random.SeedSequence(seed).spawn(len(opponents))
+    loss = 0.0
+    rows = []
+    for (kind, floor, enemy), stream in zip(opponents, streams):
+        results = simulator.simulate_fights(grown(player, floor, points_per_floor), enemy, n_fights,
+                                            policy, np.random.default_rng(stream))
+        win_rate = float(results.won.mean())
+        turns = float(results.turns[results.won].mean()) if results.won.any() else float(simulator.MAX_TURNS)
+        loss += (WIN_RATE_WEIGHT * band_miss(win_rate, band(targets, kind, floor, 'win_rate')) +
+                 band_miss(turns, band(targets, kind, floor, 'turns')))
+        rows.append({'kind': kind, 'floor': floor, 'enemy': enemy['name'], 'win_rate': win_rate, 'turns': turns})
+    return loss, rows
+
+
+def _evaluate_job(job):
+    player, params, opponents, targets, n_fights, policy, points_per_floor, seed = job
+    return evaluate(with_params(player, params), opponents, targets, n_fights, policy, points_per_floor, seed)
+
+
+def load_opponents(game_data):
+    """
+    Every enemy and boss in raw game data as (kind, floor, record), like ``simulator.load_roster``.
+    """
+    by_floor = lambda item: int(item[0])
+    opponents = [('enemy', int(floor), enemy)
+                 for floor, enemies in sorted(game_data['ENEMIES'].items(), key=by_floor) for enemy in enemies]
+    opponents += [('boss', int(floor), boss) for floor, boss in sorted(game_data['BOSSES'].items(), key=by_floor)]
+    return opponents
+
+
+def tune(data=DATA_FILE, targets=DEFAULT_TARGETS, generations=30, population=16, n_fights=2000,
+         policy='skills', points_per_floor=25, workers=None, seed=0):
+    """
+    Search every class for values that fit the targets.
+
+    Returns:
+        tuple: (proposed game data, report dict)
+    """
+    with open(data) as f:
+        game_data = json.load(f)
+    # The raw json rather than compiled content, whose read-only records do not pickle
+    classes = game_data['CLASSES']
+    opponents = load_opponents(game_data)
+    rng = np.random.default_rng(seed)
+    search_seed, check_seed = np.random.SeedSequence(seed).generate_state(2)
+
+    def job(name, params, run_seed=search_seed):
+        return (classes[name], params, opponents, targets, n_fights, policy, points_per_floor, int(run_seed))
+
+    originals = {name: tunable(player) for name, player in classes.items()}
+    best = dict(originals)
+    step = STEP
+    with ProcessPoolExecutor(workers) as pool:
+        names = list(classes)
+        losses = dict(zip(names, (loss for loss, _ in pool.map(_evaluate_job, [job(n, best[n]) for n in names]))))
+        for _ in range(generations):
+            candidates = [(name, mutate(best[name], originals[name], step, rng))
+                          for name in names for _ in range(population)]
+            scored = pool.map(_evaluate_job, [job(name, params) for name, params in candidates],
+                              chunksize=max(1, len(candidates) // (4 * (workers or os.cpu_count() or 1))))
+            for (name, params), (loss, _) in zip(candidates, scored):
+                if loss < losses[name]:
+                    best[name], losses[name] = params, loss
+            step *= STEP_DECAY
+
+        # Judge both versions on dice the search never saw
+        checks = [job(name, params, check_seed) for name in names for params in (originals[name], best[name])]
+        checked = iter(pool.map(_evaluate_job, checks))
+
+    report = {'policy': policy, 'fights': n_fights, 'generations': generations, 'classes': {}}
+    proposed = copy.deepcopy(game_data)
+    for name in names:
+        (loss_before, rows_before), (loss_after, rows_after) = next(checked), next(checked)
+        proposed['CLASSES'][name] = with_params(game_data['CLASSES'][name], best[name])
+        report['classes'][name] = {
+            'loss_before': loss_before,
+            'loss_after': loss_after,
+            'changes': {key: [originals[name][key], value] for key, value in best[name].items()
+                        if value != originals[name][key]},
+            'matchups': [dict(after, win_rate_before=before['win_rate'], turns_before=before['turns'],
+                              win_rate_band=band(targets, after['kind'], after['floor'], 'win_rate'),
+                              turns_band=band(targets, after['kind'], after['floor'], 'turns'))
+                         for before, after in zip(rows_before, rows_after)],
+        }
+    return proposed, report
+
+
+def format_report(report):
+    """
+    Render a tuning report as plain text.
+    """
+    lines = [f"{report['generations']} generations, {report['fights']} fights per matchup, "
+             f"{report['policy']} policy"]
+    for name, result in report['classes'].items():
+        lines.append("")
+        lines.append(f"{name}: miss {result['loss_before']:.2f} -> {result['loss_after']:.2f}")
+        for key, (before, after) in result['changes'].items():
+            lines.append(f"  {key}: {before} -> {after}")
+        lines.append(f"  {'Floor':>5} {'Opponent':<24} {'Win %':>15} {'Band':>9} {'Turns':>13} {'Band':>7}")
+        for row in result['matchups']:
+            opponent = row['enemy'] + (' (boss)' if row['kind'] == 'boss' else '')
+            win_low, win_high = row['win_rate_band']
+            turns_low, turns_high = row['turns_band']
+            lines.append(f"  {row['floor']:>5} {opponent:<24} "
+                         f"{row['win_rate_before'] * 100:>6.1f} -> {row['win_rate'] * 100:>5.1f} "
+                         f"{win_low * 100:>3.0f}-{win_high * 100:<3.0f}  "
+                         f"{row['turns_before']:>5.1f} -> {row['turns']:>4.1f} {turns_low:>3g}-{turns_high:<3g}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Tune class stats and skills towards target win rates.")
+    parser.add_argument('--data', default=DATA_FILE)
+    parser.add_argument('--targets', default=None, help="JSON file of target bands (default: built in)")
+    parser.add_argument('--generations', type=int, default=30)
+    parser.add_argument('--population', type=int, default=16, help="candidates per class per generation")
+    parser.add_argument('--fights', type=int, default=2000, help="fights per matchup")
+    parser.add_argument('--policy', choices=['basic', 'skills'], default='skills')
+    parser.add_argument('--points-per-floor', type=int, default=25, help="skill points gained per floor")
+    parser.add_argument('--workers', type=int, default=None, help="processes (default: one per core)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default=PROPOSED_FILE, help="where to write the proposed data file")
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    args = parser.parse_args(argv)
+
+    targets = DEFAULT_TARGETS
+    if args.targets:
+        with open(args.targets) as f:
+            overrides = json.load(f)
+        # A kind's bands are merged one by one, so a file may set only the ones it changes
+        targets = dict(overrides)
+        for kind, bands in DEFAULT_TARGETS.items():
+            targets[kind] = dict(bands, **overrides.get(kind, {}))
+
+    proposed, report = tune(args.data, targets, args.generations, args.population, args.fights,
+                            args.policy, args.points_per_floor, args.workers, args.seed)
+    with open(args.out, 'w') as f:
+        json.dump(proposed, f, indent=2)
+    print(json.dumps(report, indent=2) if args.json else format_report(report))
+    print(f"\nProposed data written to {args.out}")
+
+
+if __name__ == '__main__':
+    main()